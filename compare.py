@@ -1,86 +1,350 @@
 #!/usr/bin/python3
 
+import argparse
+import concurrent.futures
+import importlib.util
+import json
 import os
+import pickle
 import re
+import requests
 import sys
-import subprocess
+import xml.etree.ElementTree as ET
 import yaml
+from urllib.parse import quote
+
+# the libyaml loader is many times faster, if it's there
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'ci-tools')
 
 ANSIBLE_INVENTORY = os.environ.get('ANSIBLE_INVENTORY', '/home/dmick/src/ceph/ceph-sepia-secrets/ansible/inventory')
 if ANSIBLE_INVENTORY.endswith('/sepia'):
     ANSIBLE_INVENTORY=ANSIBLE_INVENTORY[:-6]
 
+JENKINS_CONTROLLERS = [
+    os.environ.get('JENKINS_HOST', 'jenkins.ceph.com'),
+    '2.jenkins.ceph.com',
+]
+if 'JENKINS_CONTROLLERS' in os.environ:
+    JENKINS_CONTROLLERS = os.environ['JENKINS_CONTROLLERS'].split(',')
+
+# set JENKINS_USER and JENKINS_TOKEN in environment for --apply
+
+def load_jenkins_tags():
+    '''
+    Load jenkins-tags.py (from next to this file, even if we're run
+    through a symlink) as a module
+    '''
+    path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'jenkins-tags.py')
+    spec = importlib.util.spec_from_file_location('jenkins_tags', path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
 def collect_jenkins_slaves():
-    jenk_proc = subprocess.run(["jenkins-tags", "-o", "-d", " ",],
-                               capture_output=True, check=True)
-    lines = jenk_proc.stdout.decode().split('\n')
-    os.environ['JENKINS_HOST'] = '2.jenkins.ceph.com'
-    jenk_proc = subprocess.run(["jenkins-tags", "-o", "-d", " ",],
-                               capture_output=True, check=True)
-    lines += jenk_proc.stdout.decode().split('\n')
-    return sorted([l.strip() for l in lines if l])
+    '''
+    All agents of all JENKINS_CONTROLLERS (fetched at the same time),
+    as jenkins-tags host records, sorted by name
+    '''
+    jt = load_jenkins_tags()
+    hosts = jt.list_hosts(JENKINS_CONTROLLERS, refresh=True)
+    return sorted(hosts, key=lambda h: h['name'])
 
 
-def collect_ansible_hosts():
-    ans_proc = subprocess.run(
-        [
-        "/home/dmick/v/bin/ansible-playbook",
-        "--list-hosts",
-        "--limit",
-        "jenkins_builders",
-        "slave.yml",
-        ],
-        capture_output=True,
-        check=True)
-    ans = list()
-    collect = False
-    for l in ans_proc.stdout.decode().split('\n'):
-        if l.startswith('    hosts'):
-            collect = True
-        if not collect:
+def file_stamps(paths):
+    return {p: (st.st_mtime_ns, st.st_size) for p in paths for st in [os.stat(p)]}
+
+def cached_parse(name, paths, parse):
+    '''
+    Return parse(paths), reusing the result saved last time as long as
+    none of paths has changed mtime or size since then
+    '''
+    cachefile = os.path.join(CACHE_DIR, f'compare-{name}.pickle')
+    stamps = file_stamps(paths)
+    try:
+        with open(cachefile, 'rb') as f:
+            saved = pickle.load(f)
+        if saved['inventory'] == ANSIBLE_INVENTORY and saved['stamps'] == stamps:
+            return saved['result']
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+        pass
+    result = parse(paths)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = f'{cachefile}.{os.getpid()}'
+    with open(tmp, 'wb') as f:
+        pickle.dump(dict(inventory=ANSIBLE_INVENTORY, stamps=stamps, result=result), f)
+    os.replace(tmp, cachefile)
+    return result
+
+def expand_host_pattern(pattern):
+    '''
+    Expand ansible's host[01:10] numeric ranges
+
+    >>> expand_host_pattern('smithi[008:010].front')
+    ['smithi008.front', 'smithi009.front', 'smithi010.front']
+    '''
+    m = re.search(r'\[(\d+):(\d+)\]', pattern)
+    if not m:
+        return [pattern]
+    width = len(m.group(1))
+    hosts = list()
+    for n in range(int(m.group(1)), int(m.group(2)) + 1):
+        hosts += expand_host_pattern(f'{pattern[:m.start()]}{n:0{width}d}{pattern[m.end():]}')
+    return hosts
+
+def parse_inventory(paths):
+    '''
+    Read INI-style inventory files into a dict of group name to
+    {'hosts': set, 'children': set}
+    '''
+    groups = dict()
+    for path in paths:
+        group, kind = 'ungrouped', 'hosts'
+        with open(path) as f:
+            for line in f:
+                line = line.split('#')[0].split(';')[0].strip()
+                if not line:
+                    continue
+                if line.startswith('['):
+                    group, _, kind = line.strip('[]').partition(':')
+                    kind = kind or 'hosts'
+                    groups.setdefault(group, dict(hosts=set(), children=set()))
+                    continue
+                if kind == 'hosts':
+                    groups.setdefault(group, dict(hosts=set(), children=set()))
+                    groups[group]['hosts'].update(expand_host_pattern(line.split()[0]))
+                elif kind == 'children':
+                    groups[group]['children'].add(line.split()[0])
+    return groups
+
+def inventory_files():
+    '''
+    The INI inventory file(s): ANSIBLE_INVENTORY/sepia, or the files in
+    it if it's a directory.  YAML inventory files aren't read.
+    '''
+    path = ANSIBLE_INVENTORY + '/sepia'
+    if not os.path.isdir(path):
+        return [path]
+    files = list()
+    for f in sorted(os.listdir(path)):
+        if f.startswith('.'):
+            continue
+        if f.endswith(('.yml', '.yaml')):
+            print(f'not reading YAML inventory {os.path.join(path, f)}', file=sys.stderr)
             continue
-        ans.append(l.strip())
-    return sorted(ans)
+        files.append(os.path.join(path, f))
+    return files
+
+def group_hosts(groups, group, seen=None):
+    if seen is None:
+        seen = set()
+    if group in seen or group not in groups:
+        return set()
+    seen.add(group)
+    hosts = set(groups[group]['hosts'])
+    for child in groups[group]['children']:
+        hosts |= group_hosts(groups, child, seen)
+    return hosts
+
+def collect_ansible_hosts():
+    '''
+    Hosts in the jenkins_builders group, read straight from the
+    inventory rather than with ansible-playbook --list-hosts
+    '''
+    groups = cached_parse('inventory', inventory_files(), parse_inventory)
+    return sorted(group_hosts(groups, 'jenkins_builders'))
+
+def load_group_vars(paths):
+    with open(paths[0]) as y:
+        return yaml.load(y, Loader=YAML_LOADER)
 
 def collect_ansible_hosts_and_tags():
-    ans = list()
-    with open(ANSIBLE_INVENTORY + '/group_vars/jenkins_builders.yml') as y:
-        groupvars = yaml.safe_load(y)
-    for k,v in groupvars['jenkins_labels'].items():
-        ans.append(f'{k} {v}')
-    return sorted(ans)
+    '''
+    dict of host name to label string, from the jenkins_builders group_vars
+    '''
+    groupvars = cached_parse('group_vars', [ANSIBLE_INVENTORY + '/group_vars/jenkins_builders.yml'],
+                             load_group_vars)
+    return groupvars['jenkins_labels']
+
+def canonical(name):
+    '''
+    Short, lowercase host name, so 'smithi015' from Jenkins and
+    'smithi015.front.sepia.ceph.com' from Ansible are the same host
+    '''
+    return name.lower().split('.')[0]
 
-def split_sort_join(s):
-    return ' '.join(sorted(s.split()))
+def jenkins_tag_sets(jenk):
+    '''
+    dict of (controller, canonical name) to set of labels (less the
+    node's own label) for jenkins-tags host records, so a host on more
+    than one controller is checked on each of them
+    '''
+    tagsets = dict()
+    for j in jenk:
+        name = j['name']
+        tagsets[(j['controller'], canonical(name))] = {t for t in j['tags'] if '+' not in t and t != name}
+    return tagsets
+
+def ansible_tag_sets(ans):
+    tagsets = dict()
+    for host, tags in ans.items():
+        tags = set(str(tags).split())
+        name = canonical(host)
+        if name in tagsets and tagsets[name] != tags:
+            print(f'{host}: more than one jenkins_labels entry for {name}, using the first', file=sys.stderr)
+            continue
+        tagsets.setdefault(name, tags)
+    return tagsets
+
+def compare(jtags, atags, builders=()):
+    '''
+    Join jenkins_tag_sets() and ansible_tag_sets() results and report
+    hosts only in Jenkins, hosts only in Ansible, hosts whose labels
+    differ (with the labels only each side has), and hosts that match.
+    A host on more than one controller is compared (and reported, as
+    'host [controller]') once per controller, and listed in
+    multiple_controllers.  Also report any of builders (canonical names
+    of hosts in the inventory's jenkins_builders group) that have no
+    labels.
+    '''
+    controllers = dict()
+    for controller, host in jtags:
+        controllers.setdefault(host, list()).append(controller)
+    diff = dict(
+        only_jenkins=sorted(controllers.keys() - atags.keys()),
+        only_ansible=sorted(atags.keys() - controllers.keys()),
+        differ=dict(),
+        match=list(),
+        multiple_controllers={host: sorted(c) for host, c in sorted(controllers.items()) if len(c) > 1},
+        unlabeled=sorted(set(builders) - atags.keys()),
+    )
+    for controller, host in sorted(jtags, key=lambda k: (k[1], k[0])):
+        if host not in atags:
+            continue
+        key = f'{host} [{controller}]' if host in diff['multiple_controllers'] else host
+        j, a = jtags[(controller, host)], atags[host]
+        if j == a:
+            diff['match'].append(key)
+        else:
+            diff['differ'][key] = dict(
+                host=host,
+                controller=controller,
+                jenkins=sorted(j),
+                ansible=sorted(a),
+                only_jenkins=sorted(j - a),
+                only_ansible=sorted(a - j),
+            )
+    return diff
+
+def set_node_labels(session, base, node, labels):
+    '''
+    Set node's labels (a space-separated string) in its config.xml on
+    the controller at base.  Returns False if they were already that.
+    '''
+    url = f'{base}/computer/{quote(node)}/config.xml'
+    resp = session.get(url)
+    resp.raise_for_status()
+    root = ET.fromstring(resp.content)
+    label = root.find('label')
+    if label is None:
+        label = ET.SubElement(root, 'label')
+    if (label.text or '').split() == labels.split():
+        return False
+    label.text = labels
+    resp = session.post(url, data=ET.tostring(root, encoding='utf-8'),
+                        headers={'Content-Type': 'application/xml'})
+    resp.raise_for_status()
+    return True
+
+def apply_labels(jt, jenk, diff, atags, workers=8):
+    '''
+    Push the Ansible labels of every host in diff['differ'] to its node
+    on its controller, workers at a time over one session.  Returns
+    a dict of diff['differ'] key to error for the ones that failed.
+    '''
+    records = {(j['controller'], canonical(j['name'])): j for j in jenk}
+    session = requests.Session()
+    user, token = os.environ.get('JENKINS_USER'), os.environ.get('JENKINS_TOKEN')
+    if user and token:
+        session.auth = (user, token)
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    errors = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = dict()
+        for host, d in diff['differ'].items():
+            rec = records[(d['controller'], d['host'])]
+            labels = ' '.join(sorted(atags[d['host']]))
+            f = ex.submit(set_node_labels, session, jt.controller_url(rec['controller']), rec['node'], labels)
+            futures[f] = host
+        for f in concurrent.futures.as_completed(futures):
+            host = futures[f]
+            try:
+                changed = f.result()
+                print(f'{host}: {"updated" if changed else "already up to date"}')
+            except (requests.exceptions.RequestException, ET.ParseError) as e:
+                errors[host] = str(e)
+                print(f'{host}: failed: {e}', file=sys.stderr)
+    return errors
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-j', '--json', action='store_true', help='Output differences as json')
+    ap.add_argument('-a', '--apply', action='store_true', help='Set the Jenkins labels of differing hosts to the Ansible labels')
+    ap.add_argument('-u', '--unlabeled', action='store_true', help='Also list jenkins_builders hosts (from the inventory) with no labels')
+    ap.add_argument('-w', '--workers', type=int, default=8, help='Nodes to update at once with --apply (default 8)')
+    return ap.parse_args()
 
 
 def main():
+    args = parse_args()
     jenk = collect_jenkins_slaves()
     '''
-    smithi015 172.21.15.15+smithi015 centos7 libvirt smithi vagrant
+    {'name': 'smithi015', 'tags': ['172.21.15.15+smithi015', 'centos7', 'libvirt', 'smithi', 'vagrant'], ...}
     '''
     ans = collect_ansible_hosts_and_tags()
+    builders = ()
+    if args.unlabeled:
+        try:
+            builders = [canonical(h) for h in collect_ansible_hosts()]
+        except OSError as e:
+            print(f'not checking for unlabeled builders: {e}', file=sys.stderr)
+    diff = compare(jenkins_tag_sets(jenk), ansible_tag_sets(ans), builders)
 
-    for j in jenk:
-        jhost, jtags = j.split(maxsplit=1)
-        jhost = jhost.replace(':', '')
-        for a in ans:
-            ahost, atags = a.split(maxsplit=1)
-            if ahost not in jhost and jhost not in ahost:
-                continue
-            jtags = re.sub(" OFFLINE.*$", "", jtags)
-            jtags = jtags.split(maxsplit=1)[1]
-            atags = split_sort_join(atags)
-            jtags = split_sort_join(jtags)
-
-            if jtags != atags:
-                print(f'{jhost}')
-                print(f'jenkins tags: {jtags}')
-                print(f'ansible tags: {atags}')
-                print()
-                break
-            else:
-                print(f'{ahost} checks out')
+    if args.apply:
+        atags = ansible_tag_sets(ans)
+        errors = apply_labels(load_jenkins_tags(), jenk, diff, atags, args.workers)
+        # check every node we meant to change, in one bulk re-read; one
+        # that's gone or still wrong on its controller doesn't pass
+        after = jenkins_tag_sets(collect_jenkins_slaves())
+        still = sorted(key for key, d in diff['differ'].items()
+                       if after.get((d['controller'], d['host'])) != atags[d['host']])
+        if still:
+            print(f'still differ: {" ".join(still)}', file=sys.stderr)
+        return 1 if errors or still else 0
+
+    if args.json:
+        print(json.dumps(diff))
+        return 0
+
+    for host in diff['match']:
+        print(f'{host} checks out')
+    print()
+    for host, d in diff['differ'].items():
+        print(f'{host}')
+        print(f'jenkins tags: {" ".join(d["jenkins"])}')
+        print(f'ansible tags: {" ".join(d["ansible"])}')
+        print()
+    if diff['only_jenkins']:
+        print(f'only in jenkins: {" ".join(diff["only_jenkins"])}')
+    if diff['only_ansible']:
+        print(f'only in ansible: {" ".join(diff["only_ansible"])}')
+    for host, controllers in diff['multiple_controllers'].items():
+        print(f'{host} is on more than one controller: {" ".join(controllers)}')
+    if diff['unlabeled']:
+        print(f'jenkins_builders without labels: {" ".join(diff["unlabeled"])}')
 
 
 if __name__ == "__main__":
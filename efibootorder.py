@@ -14,10 +14,17 @@
 # in that order.
 # Without --fix it only reports.
 #
+# Hosts are checked -j at a time, each BMC request limited by
+# --connect-timeout and --read-timeout, so a hung BMC just shows up as
+# unreachable.  Results print in the order the hosts were given,
+# followed by a count of ok, needs-fix and unreachable hosts.
+#
 # put ipmi ipmiuser:ipmipass in ~/.ipmicreds
 #
 
 import argparse
+import concurrent.futures
+import functools
 import json
 import os
 import pprint
@@ -33,15 +40,29 @@ EFISHELLSTR='EFI Shell'
 HARDDISKSTR='UEFI Hard Disk'
 PXESTR='F0) UEFI PXE IPv4'
 
-ipmiuser, ipmipass = open(os.path.expanduser('~/.ipmicreds')). read().strip().split(':')
-
-def get_bootorder(host):
+@functools.lru_cache(maxsize=None)
+def ipmi_creds():
+    ipmiuser, ipmipass = open(os.path.expanduser('~/.ipmicreds')).read().strip().split(':')
+    return ipmiuser, ipmipass
+
+def make_session(workers):
+    '''
+    One session for all the workers, with a connection pool that big
+    '''
+    session = requests.Session()
+    session.verify = False
+    session.auth = ipmi_creds()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+    session.mount('https://', adapter)
+    return session
+
+def get_bootorder(host, session=None, timeout=None):
     if 'ipmi' not in host:
         host = host + '.ipmi.sepia.ceph.com'
-    resp = requests.get(
+    session = session or make_session(1)
+    resp = session.get(
         url=f'https://{host}/redfish/v1/Systems/1/Oem/Supermicro/FixedBootOrder',
-        verify=False,
-        auth=(ipmiuser,ipmipass),
+        timeout=timeout,
     )
     resp.raise_for_status()
     return resp.json()['FixedBootOrder']
@@ -94,12 +115,12 @@ def fix_bootorder(host, boot_order):
 
 # curl -k -v -X PATCH -d '{"FixedBootOrder": ["UEFI Network:(B1/D0/F0) UEFI PXE IPv4: Intel(R) Ethernet Controller E810-XXV for SFP(MAC:905A08776332)","UEFI CD/DVD","UEFI USB Hard Disk", "UEFI USB CD/DVD","UEFI USB Key","UEFI USB Floppy","UEFI USB Lan", "UEFI AP:UEFI: Built-in EFI Shell", "UEFI Hard Disk:ubuntu"]}' 'https://trial198.ipmi/redfish/v1/Systems/1/Oem/Supermicro/FixedBootOrder'
 
-def write_bootorder(host, bootorder):
+def write_bootorder(host, bootorder, session=None, timeout=None):
     if 'ipmi' not in host:
         host = host + '.ipmi.sepia.ceph.com'
-    resp = requests.patch(
-        verify=False,
-        auth=(ipmiuser,ipmipass),
+    session = session or make_session(1)
+    resp = session.patch(
+        timeout=timeout,
         headers={"Content-Type": "application/json"},
         url=f'https://{host}/redfish/v1/Systems/1/Oem/Supermicro/FixedBootOrder',
         data=json.dumps({"FixedBootOrder": bootorder}),
@@ -107,9 +128,8 @@ def write_bootorder(host, bootorder):
     resp.raise_for_status()
 
     # $ curl -k -v -X POST -d '{"ResetType": "GracefulRestart"}' 'https://trial198.ipmi/redfish/v1/Systems/1/Actions/ComputerSystem.Reset'
-    resp = requests.post(
-        verify=False,
-        auth=(ipmiuser,ipmipass),
+    resp = session.post(
+        timeout=timeout,
         headers={"Content-Type": "application/json"},
         url=f'https://{host}/redfish/v1/Systems/1/Actions/ComputerSystem.Reset',
         data='{"ResetType":"GracefulRestart"}',
@@ -118,9 +138,38 @@ def write_bootorder(host, bootorder):
     resp.raise_for_status()
 
 
+def check_host(hostname, fix=False, session=None, timeout=None):
+    '''
+    Check (and with fix, rewrite) hostname's boot order.  Returns its
+    status ('ok', 'needs-fix' or 'fixed') and the lines to print for it.
+    '''
+    bootorder = get_bootorder(hostname, session, timeout)
+
+    if bootorder_ok(bootorder):
+        return 'ok', [f'{hostname} ok']
+
+    new_order = fix_bootorder(hostname, bootorder)
+    lines = [hostname]
+    for o, n in zip(bootorder, new_order):
+        if o != n:
+            lines.append(f'{o} ===> {n}')
+        else:
+            lines.append(f'{o}')
+    if not fix:
+        return 'needs-fix', lines
+    write_bootorder(hostname, new_order, session, timeout)
+    validate_bootorder = get_bootorder(hostname, session, timeout)
+    if new_order != validate_bootorder:
+        raise RuntimeError(f'{hostname} boot order did not change')
+    return 'fixed', lines
+
+
 def parse_args():
     ap = argparse.ArgumentParser()
     ap.add_argument('-f', '--fix', action='store_true', help='swap shell and disk if out of order (default is to warn only)')
+    ap.add_argument('-j', '--jobs', type=int, default=16, help='hosts to check at once (default 16)')
+    ap.add_argument('--connect-timeout', type=float, default=5, help='seconds to wait to connect to a BMC (default 5)')
+    ap.add_argument('--read-timeout', type=float, default=60, help='seconds to wait for a BMC to answer (default 60)')
     ap.add_argument('host', nargs='*', help='host')
     return ap.parse_args()
 
@@ -128,25 +177,29 @@ def parse_args():
 def main():
     args = parse_args()
     hostnames = args.host
-    for hostname in hostnames:
-        bootorder = get_bootorder(hostname)
-
-        if bootorder_ok(bootorder):
-            print(f'{hostname} ok')
-            continue
-
-        new_order = fix_bootorder(hostname, bootorder)
-        print(hostname)
-        for o, n in zip(bootorder, new_order):
-            if o != n:
-                print(f'{o} ===> {n}')
-            else:
-                print(f'{o}')
-        if args.fix:
-            write_bootorder(hostname, new_order)
-            validate_bootorder = get_bootorder(hostname)
-            if new_order != validate_bootorder:
-                raise RuntimeError(f'{hostname} boot order did not change')
+    timeout = (args.connect_timeout, args.read_timeout)
+    session = make_session(args.jobs)
+
+    counts = {status: 0 for status in ('ok', 'needs-fix', 'fixed', 'unreachable', 'failed')}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as ex:
+        futures = [ex.submit(check_host, hostname, args.fix, session, timeout) for hostname in hostnames]
+        # print in input order, each as soon as it and those before it are done
+        for hostname, future in zip(hostnames, futures):
+            try:
+                status, lines = future.result()
+                print('\n'.join(lines))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                status = 'unreachable'
+                print(f'{hostname} unreachable: {e}')
+            except (requests.exceptions.RequestException, RuntimeError, KeyError, ValueError) as e:
+                status = 'failed'
+                print(f'{hostname} failed: {e}')
+            counts[status] += 1
+
+    summary = ', '.join(f'{n} {status}' for status, n in counts.items()
+                        if n or status in ('ok', 'needs-fix', 'unreachable'))
+    print(f'{len(hostnames)} hosts: {summary}', file=sys.stderr)
+    return 1 if counts['unreachable'] or counts['failed'] else 0
 
 
 if __name__ == "__main__":
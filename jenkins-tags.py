@@ -1,10 +1,18 @@
 #!/usr/bin/python3
 
 import argparse
+import concurrent.futures
+import json
 import os
 import sys
 import re
 import requests
+import time
+
+# just the fields host_records() uses; the full node listing also has
+# executors, monitor data, etc., and is many times bigger
+NODE_TREE = 'computer[displayName,offline,offlineCauseReason,assignedLabels[name]]'
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'ci-tools')
 
 
 def parse_args():
@@ -17,36 +25,75 @@ def parse_args():
     ap.add_argument('-n', '--negative', action='store_true', help="negate -t or -T (none of these tags present or these specific tags not present together")
     ap.add_argument('-d', '--delimiter', help="char to separate tags in output", default=',')
     ap.add_argument('-g', '--group', action="store_true", help="format for jenkins group vars")
+    ap.add_argument('-H', '--host', nargs='*', help="Jenkins controller(s) to query (default $JENKINS_HOST or jenkins.ceph.com)")
+    ap.add_argument('--ttl', type=float, default=float(os.environ.get('JENKINS_TAGS_TTL', 60)), help="seconds a saved node list is good for (default 60, or $JENKINS_TAGS_TTL)")
+    ap.add_argument('-c', '--cached', action="store_true", help="use the saved node list no matter how old it is")
+    ap.add_argument('-r', '--refresh', action="store_true", help="ignore any saved node list")
+    ap.add_argument('-s', '--stale', action="store_true", help="if the saved node list is too old, use it anyway and refresh it in the background")
 
     return ap.parse_args()
 
 
-def intersection(list1, list2):
-   '''
-   list1 is a list of REs; search for a full match for each RE
-   in each member of list2, and return the members that match
-   (fully)
+# a pattern with none of these in it can only match itself
+REGEX_CHARS = set('.^$*+?{}[]\\|()')
+
+def label_index(hosts):
+    '''
+    Map each label to the set of indices of the hosts that have it
+    '''
+    index = dict()
+    for i, host in enumerate(hosts):
+        for tag in host['tags']:
+            index.setdefault(tag, set()).add(i)
+    return index
+
 
-   >>> intersection(['foo', 'bar'], ['foobar', 'foobaz'])
-   []
-   >>> intersection(['foo.*', 'bar'], ['foobar', 'foobaz'])
-   ['foobar', 'foobaz']
-   >>> intersection(['.*baz', '.*bar'], ['foobar', 'foobaz'])
-   ['foobar', 'foobaz']
-   '''
-   return [l2 for l2 in list2 if [l1 for l1 in list1 if re.fullmatch(l1, l2)]] 
+def hosts_matching(index, pattern):
+    '''
+    Indices of hosts with a label that fully matches pattern.  Literal
+    patterns are a dict lookup; REs are compiled once and tried
+    against each distinct label, not each host's copy of it.
+    '''
+    if not REGEX_CHARS & set(pattern):
+        return index.get(pattern, set())
+    rx = re.compile(pattern)
+    matched = set()
+    for label, idxs in index.items():
+        if rx.fullmatch(label):
+            matched |= idxs
+    return matched
 
 
-def one_for_one(list1, list2):
+def select_hosts(hosts, anytags=None, alltags=None, negative=False):
     '''
-    Does list1 of patterns match list2 in at least one match per 
-    pattern?
+    Return the hosts (in order) with a label fully matching any of the
+    anytags REs, and with labels matching each of the alltags REs.  With
+    negative, return the hosts with none of anytags and without
+    all of alltags instead.
+
+    >>> hosts = [dict(name='a', tags=['arm64', 'jammy']), dict(name='b', tags=['amd64', 'jammy'])]
+    >>> [h['name'] for h in select_hosts(hosts, ['foo', 'bar'])]
+    []
+    >>> [h['name'] for h in select_hosts(hosts, ['arm.*', 'bar'])]
+    ['a']
+    >>> [h['name'] for h in select_hosts(hosts, alltags=['.*64', 'jammy'])]
+    ['a', 'b']
+    >>> [h['name'] for h in select_hosts(hosts, alltags=['amd64', 'jammy'], negative=True)]
+    ['a']
     '''
-    for pat in list1:
-        count = len([l2 for l2 in list2 if re.fullmatch(pat, l2)])
-        if count < 1:
-            return False
-    return True
+    index = label_index(hosts)
+    selected = set(range(len(hosts)))
+    if anytags:
+        anyhosts = set()
+        for pat in anytags:
+            anyhosts |= hosts_matching(index, pat)
+        selected = selected - anyhosts if negative else selected & anyhosts
+    if alltags:
+        allhosts = set(selected)
+        for pat in alltags:
+            allhosts &= hosts_matching(index, pat)
+        selected = selected - allhosts if negative else allhosts
+    return [host for i, host in enumerate(hosts) if i in selected]
 
 
 def expand_csv_to_list(l):
@@ -55,66 +102,165 @@ def expand_csv_to_list(l):
         newl = l[0].split(',')
     return newl
 
-sets_of_interest = (
-    ("arm64", "jammy"),
-    ("amd64", "jammy"),
-    ("arm64", "centos9"),
-    ("amd64", "centos9"),
-)
+def controller_url(host):
+    '''
+    Base URL for a controller: https://host, unless host is already a
+    URL (e.g. http://localhost:8080 for a test instance)
+    '''
+    return host.rstrip('/') if '://' in host else f'https://{host}'
 
-def main():
-    host = os.environ.get('JENKINS_HOST', 'jenkins.ceph.com')
 
-    args = parse_args()
-    res = requests.get(f'https://{host}/computer/api/json')
+def cache_path(host):
+    name = re.sub(r'[^\w.-]', '_', host)
+    return os.path.join(CACHE_DIR, f'jenkins-tags-{name}.json')
+
+
+def fetch_nodes(host):
+    '''
+    Get host's node list from Jenkins, and save it for next time
+    '''
+    res = requests.get(f'{controller_url(host)}/computer/api/json', params=dict(tree=NODE_TREE),
+                       headers={'Accept-Encoding': 'gzip'})
     res.raise_for_status()
     nodes = res.json()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = cache_path(host)
+    tmp = f'{path}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(nodes, f)
+    os.replace(tmp, path)
+    return nodes
+
+
+def refresh_in_background(hosts):
+    '''
+    Fork off fetch_nodes() for each of hosts, detached from our output
+    so that $(jenkins-tags ...) doesn't wait for it
+    '''
+    if os.fork():
+        return
+    try:
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.setsid()
+        for host in hosts:
+            try:
+                fetch_nodes(host)
+            except Exception:
+                pass
+    finally:
+        os._exit(0)
+
+
+def saved_nodes(host):
+    '''
+    Return host's saved node list and its age in seconds, or (None, None)
+    '''
+    path = cache_path(host)
+    try:
+        age = time.time() - os.path.getmtime(path)
+        with open(path) as f:
+            return json.load(f), age
+    except (OSError, ValueError):
+        return None, None
+
+
+def get_nodes(hosts, ttl=60, cached=False, refresh=False, stale=False):
+    '''
+    Return a dict of each of hosts to its node list, from the copy
+    saved in CACHE_DIR if it's less than ttl seconds old (or any age,
+    if cached), else from Jenkins; those that need fetching are fetched
+    at the same time.  With stale, old copies are returned as-is and
+    refreshed in the background, so tags keep coming even if Jenkins is
+    slow or down.
+    '''
+    result = dict()
+    tofetch = list()
+    torefresh = list()
+    for host in hosts:
+        nodes, age = (None, None) if refresh else saved_nodes(host)
+        if nodes is not None and (cached or age < ttl):
+            result[host] = nodes
+        elif nodes is not None and stale:
+            result[host] = nodes
+            torefresh.append(host)
+        else:
+            tofetch.append(host)
+    if tofetch:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(tofetch)) as ex:
+            for host, nodes in zip(tofetch, ex.map(fetch_nodes, tofetch)):
+                result[host] = nodes
+    if torefresh:
+        # only fork once the fetch threads are gone
+        refresh_in_background(torefresh)
+    return {host: result[host] for host in hosts}
+
+
+def host_records(nodes, controller):
+    '''
+    Turn a node list into a list of agent hosts as dicts of name
+    (without IP addr), node (Jenkins' name for it), offline, tags,
+    offline_reason, and controller
+    '''
     hosts = []
     for host in nodes['computer']:
         if host['_class'] != 'hudson.slaves.SlaveComputer':
             continue
-        if not (args.offline or args.onlyoffline or args.group) and host['offline']:
-            continue
-        if args.onlyoffline and not host['offline']:
-            continue
 
         tags = list()
         for d in host['assignedLabels']:
-            tags.extend([v for k,v in d.items()])
+            tags.append(d['name'])
         tags = sorted(tags)
 
-        args.tags = expand_csv_to_list(args.tags)
-        args.alltags = expand_csv_to_list(args.alltags)
-
-        if not args.negative:
-            # skip if tags don't contain any of the requested tags
-            if args.tags and not intersection(args.tags, tags):
-                continue
-
-            # skip if tags don't contain all of the requested tags
-            if args.alltags:
-                i = intersection(args.alltags, tags)
-                if not one_for_one(args.alltags, i):
-                    continue
-        else:
-            # skip if tags contain any of the requested tags
-            if args.tags and intersection(args.tags, tags):
-                continue
-
-            # skip if tags contain all of the requested tags
-            if args.alltags:
-                i = intersection(args.alltags, tags)
-                if one_for_one(args.alltags, i):
-                    continue
-
-
         name = host['displayName']
         # don't output the IP addr
         if '+' in name:
             name = name[name.index('+')+1:]
 
         offline_reason = host.get('offlineCauseReason')
-        hosts.append({"name": name, "offline": host['offline'], "tags": tags, "offline_reason": offline_reason})
+        hosts.append({"name": name, "node": host['displayName'], "offline": host['offline'], "tags": tags,
+                      "offline_reason": offline_reason, "controller": controller})
+    return hosts
+
+
+def list_hosts(controllers, ttl=60, cached=False, refresh=False, stale=False):
+    '''
+    All the agent hosts (see host_records()) of all of controllers,
+    fetched as get_nodes() does.  This is the entry point for other
+    tools; load this file with importlib, since its name isn't importable.
+    '''
+    hosts = []
+    for controller, nodes in get_nodes(controllers, ttl, cached, refresh, stale).items():
+        hosts.extend(host_records(nodes, controller))
+    return hosts
+
+
+sets_of_interest = (
+    ("arm64", "jammy"),
+    ("amd64", "jammy"),
+    ("arm64", "centos9"),
+    ("amd64", "centos9"),
+)
+
+def main():
+    args = parse_args()
+    controllers = args.host
+    if not controllers:
+        controllers = [os.environ.get('JENKINS_HOST', 'jenkins.ceph.com')]
+    controllers = expand_csv_to_list(controllers)
+    args.tags = expand_csv_to_list(args.tags)
+    args.alltags = expand_csv_to_list(args.alltags)
+
+    hosts = []
+    for host in list_hosts(controllers, args.ttl, args.cached, args.refresh, args.stale):
+        if not (args.offline or args.onlyoffline or args.group) and host['offline']:
+            continue
+        if args.onlyoffline and not host['offline']:
+            continue
+        hosts.append(host)
+
+    hosts = select_hosts(hosts, args.tags, args.alltags, args.negative)
 
     if args.list:
         print(args.delimiter.join([host['name'] for host in hosts]))
@@ -131,7 +277,8 @@ def main():
                 offlinestr = 'OFFLINE'
                 if 'offline_reason' in host:
                     offlinestr += f' {host["offline_reason"]}'
-            print(f'{host["name"]}: {args.delimiter.join(host["tags"])} {offlinestr}')
+            controllerstr = f' [{host["controller"]}]' if len(controllers) > 1 else ''
+            print(f'{host["name"]}: {args.delimiter.join(host["tags"])} {offlinestr}{controllerstr}')
 
             for t in sets_of_interest:
                 s = set(t)
@@ -1,22 +1,59 @@
 #!/home/dmick/v/bin/python3 
 import argparse
+import collections
+import concurrent.futures
 import datetime
+import importlib.util
 fromtimestamp=datetime.datetime.fromtimestamp
 import jenkins
 import json
 import os
 import re
+import requests
+import sqlite3
 import sys
+import threading
 import time
 
 # set JENKINS_USER and JENKINS_TOKEN in environment
 
+JENKINS_URL = 'https://jenkins.ceph.com'
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'ci-tools')
+
+# Only the build fields output() actually uses; asking Jenkins for just
+# these (with tree=) is a small fraction of the full build JSON
+BUILD_FIELDS = (
+    'number,timestamp,duration,estimatedDuration,result,building,'
+    'actions[causes[shortDescription],parameters[name,value],waitingTimeMillis]'
+)
+# bucket edges (minutes) for the --stats build time histogram
+STATS_HIST_MINUTES = [5, 15, 30, 60, 120, 240]
+# build parameters shown without -P
+POIS = ['BRANCH', 'ARCHS', 'DISTROS', 'FLAVOR']
+# Jenkins never returns more than this many entries in a job's 'builds'
+BULK_WINDOW = 100
+# how long the cached list of job names is good for, in seconds
+JOBINDEX_TTL = 3600
+
 def parse_args():
     ap = argparse.ArgumentParser()
     ap.add_argument("-j", "--json", action='store_true', help="Output json")
+    ap.add_argument("--ndjson", action='store_true', help="Output one json line per build as it's fetched")
     ap.add_argument("-P", "--allparams", action='store_true', help="Output all job parameters")
     ap.add_argument("-l", "--list", action='store_true', help="List all jobs and exit")
     ap.add_argument("-c", "--count", type=int, help="Limit output to this many jobs")
+    ap.add_argument("--since", help="Only builds started at/after this time (ISO date/time, or e.g. 1d/6h ago)")
+    ap.add_argument("--until", help="Only builds started at/before this time")
+    ap.add_argument("--range", help="Only builds numbered N-M (or just N)")
+    ap.add_argument("--stats", action='store_true', help="Output wait/duration percentiles and failure rate instead of builds")
+    ap.add_argument("--groupby", default='job', help="Comma-separated keys to group --stats by: 'job' and/or build parameters (e.g. BRANCH,ARCHS)")
+    ap.add_argument("--grep", help="Show console lines matching this regexp instead of build info")
+    ap.add_argument("--maxhits", type=int, help="Stop --grep after this many matching lines")
+    ap.add_argument("--tail", type=int, help="Show the last this-many console lines of each build")
+    ap.add_argument("-J", "--jobs", type=int, default=1, help="Fetch up to this many builds at once")
+    ap.add_argument("--nocache", action='store_true', help="Don't use (or update) the local build cache or job list")
+    ap.add_argument("--refresh", action='store_true', help="Refresh the cached job list even if it's not stale")
+    ap.add_argument("--nobulk", action='store_true', help="Fetch each build separately (old, slow behavior)")
     ap.add_argument('jobre', type=str, nargs="?", default='^ceph-dev-new$', help="regexp to match job name")
     return ap.parse_args() 
 
@@ -86,96 +123,614 @@ def ts_to_str(ts):
     return fromtimestamp(ts).strftime('%d %b %H:%M:%S')
 
 
+def jenkins_get(j, url):
+    '''
+    GET a Jenkins api/json url through j (for auth) and return the parsed json
+    '''
+    return json.loads(j.jenkins_open(requests.Request('GET', url)))
+
+
+def get_builds_bulk(j, joburl, count=None, start=0):
+    '''
+    Fetch count builds (or all of them) of the job at joburl, newest
+    first, skipping the newest start, with only BUILD_FIELDS filled in.
+    From the top of the history, the first BULK_WINDOW builds come back
+    in one request; anything past those (or everything, for start > 0)
+    is fetched BULK_WINDOW at a time with allBuilds range slices.
+    '''
+    if start:
+        return get_builds_range(j, joburl, start, start + count if count else None)
+    rng = f'{{0,{min(count, BULK_WINDOW)}}}' if count else ''
+    builds = jenkins_get(j, f'{joburl}api/json?tree=builds[{BUILD_FIELDS}]{rng}')['builds']
+    if len(builds) < BULK_WINDOW or (count and count <= len(builds)):
+        return builds
+    # builds[] stops at BULK_WINDOW; page through the rest whole,
+    # rather than leaving each to a get_build_info()
+    return builds + get_builds_range(j, joburl, len(builds), count)
+
+
+def get_builds_range(j, joburl, start, end=None):
+    '''
+    Whole builds start through end-1 (newest first; end None means
+    to the oldest), BULK_WINDOW per request
+    '''
+    builds = list()
+    while end is None or start < end:
+        stop = start + BULK_WINDOW if end is None else min(start + BULK_WINDOW, end)
+        chunk = jenkins_get(j, f'{joburl}api/json?tree=allBuilds[{BUILD_FIELDS}]{{{start},{stop}}}')['allBuilds']
+        builds += chunk
+        if len(chunk) < stop - start:
+            break
+        start = stop
+    return builds
+
+
+def build_at(j, joburl, i):
+    '''
+    number and timestamp of the i'th newest build, or None if there
+    aren't that many
+    '''
+    b = jenkins_get(j, f'{joburl}api/json?tree=allBuilds[number,timestamp]{{{i},{i + 1}}}')['allBuilds']
+    return b[0] if b else None
+
+
+def first_build_where(j, joburl, past):
+    '''
+    Index (newest first) of the first build for which past(build) is
+    true, given that it's false for all newer builds and true for all
+    older ones; build numbers and start times both go down monotonically,
+    so that's how to find a number or time.  Gallops out from the newest
+    build and then bisects, so it costs about 2*log2(index) one-build
+    requests, rather than a download of the whole history.
+    '''
+    def past_at(i):
+        b = build_at(j, joburl, i)
+        return b is None or past(b)
+
+    if past_at(0):
+        return 0
+    lo, hi = 0, 1
+    while not past_at(hi):
+        lo, hi = hi, hi * 2
+    # past_at(lo) is false, past_at(hi) is true
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if past_at(mid):
+            hi = mid
+        else:
+            lo = mid
+    return hi
+
+
+def parse_when(s):
+    '''
+    Return a --since/--until time as ms since the epoch.  Takes
+    anything datetime.fromisoformat() does ('2024-05-01',
+    '2024-05-01 13:00'), or a number of s/m/h/d ago ('1d', '90m')
+    '''
+    m = re.fullmatch(r'(\d+)([smhd])', s)
+    if m:
+        mult = dict(s=1, m=60, h=3600, d=86400)[m.group(2)]
+        return int((time.time() - int(m.group(1)) * mult) * 1000)
+    return int(datetime.datetime.fromisoformat(s).timestamp() * 1000)
+
+
+def build_window(j, joburl, args):
+    '''
+    Turn --since/--until/--range into a (start, end) slice of the
+    job's builds, newest first; end None means no lower limit
+    '''
+    start, end = 0, None
+    if args.range:
+        low, _, high = args.range.partition('-')
+        low = int(low)
+        high = int(high) if high else low
+        start = first_build_where(j, joburl, lambda b: b['number'] <= high)
+        end = first_build_where(j, joburl, lambda b: b['number'] < low)
+    if args.until:
+        until = parse_when(args.until)
+        start = max(start, first_build_where(j, joburl, lambda b: b['timestamp'] <= until))
+    if args.since:
+        since = parse_when(args.since)
+        e = first_build_where(j, joburl, lambda b: b['timestamp'] < since)
+        end = e if end is None else min(end, e)
+    return start, end
+
+
+def share_connections(j, size):
+    '''
+    Let up to size threads share j's keep-alive connections to the
+    server instead of each opening (and throwing away) their own
+    '''
+    session = getattr(j, '_session', None)
+    if session is None:
+        return
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+def fill_builds(j, name, builds, jobs=1):
+    '''
+    Yield full build info for each of builds, in order.  Those that
+    didn't come back from the bulk request are fetched with up to
+    jobs requests in flight at once.
+    '''
+    def fill(build):
+        if 'actions' in build or 'reason' in build:
+            return build
+        return j.get_build_info(name, build['number'])
+
+    if jobs <= 1:
+        yield from map(fill, builds)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as ex:
+        yield from ex.map(fill, builds)
+
+
+def parse_build(name, bi, allparams=False):
+    '''
+    Pick reason, interesting parameters, and queue wait time out of
+    the build info bi's actions.  Returns (reason, paramdict, waitms)
+
+    {'_class': 'hudson.model.CauseAction',
+     'causes': [{'_class': 'org.jenkinsci.plugins.ghprb.GhprbCause',
+         'shortDescription': 'GitHub pull request #56203 of commit '
+                             'ab4c5daead7f26d41028625453d50bb58d3b02be,'
+                             ' no merge conflicts.'}]}
+
+     {'_class': 'jenkins.metrics.impl.TimeInQueueAction',
+      'blockedDurationMillis': 0,
+      'blockedTimeMillis': 0,
+      'buildableDurationMillis': 4,
+      'buildableTimeMillis': 4,
+      'buildingDurationMillis': 985724,
+      'executingTimeMillis': 985724,
+      'executorUtilization': 1.0,
+      'subTaskCount': 0,
+      'waitingDurationMillis': 6797,
+      'waitingTimeMillis': 6797},
+
+    '''
+    reason = "??"
+    paramdict = dict()
+    waitms = None
+    for act in bi['actions']:
+        cls = act.get('_class', None)
+        if cls is None:
+            continue
+
+        if cls.endswith('hudson.model.CauseAction'):
+            if len(act['causes']) > 1:
+                print(f'{name} #{bi["number"]} has more than one cause?', file=sys.stderr)
+            reason = act['causes'][0]['shortDescription']
+
+        if cls.endswith('ParametersAction'):
+            params = act['parameters']
+            for param in params:
+                if allparams or param['name'] in POIS:
+                    paramdict[param['name']] = param['value']
+
+        if cls.endswith('TimeInQueueAction'):
+            if bi['building'] == False:
+                waitms = act['waitingTimeMillis']
+
+    return decruft(reason), paramdict, waitms
+
+
+# bump when summarize() changes, so older cached summaries get refetched
+SUMMARY_VERSION = 2
+
+def summarize(name, bi):
+    '''
+    Boil build info down to what output() needs (keeping all the
+    parameters, so it's good for -P too); this is what gets cached
+    '''
+    reason, paramdict, waitms = parse_build(name, bi, allparams=True)
+    return dict(
+        version=SUMMARY_VERSION,
+        number=bi['number'],
+        timestamp=bi['timestamp'],
+        building=bi['building'],
+        estimatedDuration=bi['estimatedDuration'],
+        duration=bi['duration'],
+        result=bi['result'],
+        reason=reason,
+        params=paramdict,
+        waitms=waitms,
+        waittime=None if waitms is None else to_minsec(waitms),
+    )
+
+
+class BuildCache:
+    '''
+    Summaries of finished builds, which never change, kept in sqlite
+    so they only ever have to be fetched from Jenkins once.  Stored
+    summaries are committed every COMMIT_EVERY rows, so an interrupted fetch
+    keeps most of what it got.
+    '''
+    COMMIT_EVERY = 100
+
+    def __init__(self, server, path=None):
+        if path is None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            path = os.path.join(CACHE_DIR, 'jobinfo.sqlite')
+        self.server = server
+        self.uncommitted = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS builds (
+            server TEXT, job TEXT, number INTEGER, summary TEXT,
+            PRIMARY KEY (server, job, number))''')
+
+    def load(self, job):
+        '''
+        dict of build number to summary; summaries from an older
+        summarize() are left out, so they're fetched again
+        '''
+        rows = self.db.execute(
+            'SELECT number, summary FROM builds WHERE server = ? AND job = ?',
+            (self.server, job))
+        summaries = (json.loads(summary) for number, summary in rows)
+        return {s['number']: s for s in summaries if s.get('version') == SUMMARY_VERSION}
+
+    def store(self, job, summary):
+        if summary['building']:
+            return
+        self.db.execute(
+            'INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?)',
+            (self.server, job, summary['number'], json.dumps(summary)))
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_EVERY:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def get_builds_cached(j, joburl, cached, count=None, start=0):
+    '''
+    Like get_builds_bulk(), but builds already in cached (a dict of
+    build number to summary) are taken from there.  One cheap request
+    lists the build numbers; then only the newest builds down to the
+    oldest uncached one are fetched, which is normally just the few
+    since the last run plus any that were still building then.
+    '''
+    rng = f'{{{start},{start + count}}}' if count else f'{{{start},}}'
+    numbers = [b['number'] for b in
+               jenkins_get(j, f'{joburl}api/json?tree=allBuilds[number]{rng}')['allBuilds']]
+    missing = [i for i, n in enumerate(numbers) if n not in cached]
+    fetched = dict()
+    if missing:
+        for b in get_builds_bulk(j, joburl, missing[-1] + 1, start):
+            fetched[b['number']] = b
+    return [cached[n] if n in cached else fetched.get(n, dict(number=n)) for n in numbers]
+
+
+def percentiles_by_group(codes, values, ngroups, qs):
+    '''
+    For each group code 0..ngroups-1, the qs percentiles (0-100) of
+    values whose code is that group, ignoring NaNs; all groups at once,
+    off one sort.  Returns an (ngroups, len(qs)) array, NaN where a
+    group has no values.
+    '''
+    import numpy as np
+    valid = ~np.isnan(values)
+    codes, values = codes[valid], values[valid]
+    order = np.lexsort((values, codes))
+    values = values[order]
+    counts = np.bincount(codes, minlength=ngroups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    # linear interpolation between closest ranks, like np.percentile
+    pos = starts[:, None] + (np.asarray(qs) / 100.0)[None, :] * np.maximum(counts - 1, 0)[:, None]
+    lo = np.floor(pos).astype(int)
+    hi = np.ceil(pos).astype(int)
+    out = np.full(pos.shape, np.nan)
+    have = counts > 0
+    if len(values):
+        lo_v = values[np.minimum(lo, len(values) - 1)]
+        hi_v = values[np.minimum(hi, len(values) - 1)]
+        out[have] = (lo_v + (hi_v - lo_v) * (pos - lo))[have]
+    return out
+
+
+def build_stats(keys, waits, durations, failed, aborted):
+    '''
+    Group per-build columns by key and return one dict per group with
+    the build count, failure (FAILURE) and abort (ABORTED) rates,
+    p50/p90/p99 queue wait and build time (in ms), and a histogram of
+    build times.  waits and durations are NaN for builds that haven't
+    finished.
+    '''
+    import numpy as np
+    groups, codes = np.unique(np.asarray(keys, dtype=object).astype(str), return_inverse=True)
+    codes = codes.astype(np.intp)
+    ngroups = len(groups)
+    waits = np.asarray(waits, dtype=float)
+    durations = np.asarray(durations, dtype=float)
+    failed = np.asarray(failed, dtype=bool)
+    aborted = np.asarray(aborted, dtype=bool)
+    finished = ~np.isnan(durations)
+
+    total = np.bincount(codes, minlength=ngroups)
+    nfinished = np.bincount(codes, weights=finished, minlength=ngroups)
+    nfailed = np.bincount(codes, weights=failed & finished, minlength=ngroups)
+    naborted = np.bincount(codes, weights=aborted & finished, minlength=ngroups)
+    qs = (50, 90, 99)
+    waitq = percentiles_by_group(codes, waits, ngroups, qs)
+    durq = percentiles_by_group(codes, durations, ngroups, qs)
+
+    edges = np.array(STATS_HIST_MINUTES, dtype=float) * 60000
+    bins = np.searchsorted(edges, durations[finished], side='right')
+    hist = np.zeros((ngroups, len(edges) + 1), dtype=int)
+    np.add.at(hist, (codes[finished], bins), 1)
+
+    def ms(v):
+        return None if np.isnan(v) else int(v)
+
+    stats = list()
+    for g in range(ngroups):
+        stats.append(dict(
+            group=str(groups[g]),
+            builds=int(total[g]),
+            finished=int(nfinished[g]),
+            failrate=float(nfailed[g] / nfinished[g]) if nfinished[g] else None,
+            abortrate=float(naborted[g] / nfinished[g]) if nfinished[g] else None,
+            wait=dict(zip([f'p{q}' for q in qs], map(ms, waitq[g]))),
+            duration=dict(zip([f'p{q}' for q in qs], map(ms, durq[g]))),
+            histogram=hist[g].tolist(),
+        ))
+    return stats
+
+
+def print_stats(stats):
+    def ms(v):
+        return '-' if v is None else to_minsec(v)
+
+    def pct(v):
+        return '-' if v is None else f'{100 * v:.1f}'
+
+    width = max([len('group')] + [len(s['group']) for s in stats])
+    print(f'{"group":{width}} {"builds":>6} {"fail%":>6} {"abort%":>6}'
+          f' {"wait p50/p90/p99":>26} {"duration p50/p90/p99":>26}')
+    for s in stats:
+        wait = '/'.join(ms(v) for v in s['wait'].values())
+        dur = '/'.join(ms(v) for v in s['duration'].values())
+        print(f'{s["group"]:{width}} {s["builds"]:>6} {pct(s["failrate"]):>6} {pct(s["abortrate"]):>6} {wait:>26} {dur:>26}')
+    labels = [f'<{m}m' for m in STATS_HIST_MINUTES] + [f'>={STATS_HIST_MINUTES[-1]}m']
+    print()
+    print(f'{"duration histogram":{width}} {" ".join(f"{l:>6}" for l in labels)}')
+    for s in stats:
+        print(f'{s["group"]:{width}} {" ".join(f"{n:>6}" for n in s["histogram"])}')
+
+
+def console_lines(j, buildurl, stop=None):
+    '''
+    Yield a build's console output a line at a time, streamed through
+    logText/progressiveText so the whole log is never in memory.  If
+    the connection drops, pick up again at the byte offset we'd reached.
+    Gives up early if stop (a threading.Event) gets set.
+    '''
+    offset = 0
+    retried = False
+    while True:
+        req = requests.Request('GET', f'{buildurl}logText/progressiveText', params=dict(start=offset))
+        resp = j.jenkins_request(req, stream=True)
+        try:
+            # split on \n ourselves, counting every byte: iter_lines()
+            # also splits on (and drops) \r, which loses count of where
+            # we are with CRLF or \r progress output
+            buf = b''
+            for chunk in resp.iter_content(chunk_size=65536):
+                buf += chunk
+                *lines, buf = buf.split(b'\n')
+                for line in lines:
+                    if stop is not None and stop.is_set():
+                        return
+                    offset += len(line) + 1
+                    for part in line.rstrip(b'\r').split(b'\r'):
+                        yield part.decode(errors='replace')
+            if buf:
+                yield buf.rstrip(b'\r').decode(errors='replace')
+            return
+        except requests.exceptions.RequestException:
+            if retried:
+                raise
+            retried = True
+        finally:
+            resp.close()
+
+
+def scan_console(j, buildurl, args, stop):
+    '''
+    Return the --grep matches (at most --maxhits) or --tail lines
+    of one build's console
+    '''
+    if args.grep:
+        pat = re.compile(args.grep)
+        hits = list()
+        for line in console_lines(j, buildurl, stop):
+            if pat.search(line):
+                hits.append(line)
+                if args.maxhits and len(hits) >= args.maxhits:
+                    break
+        return hits
+    return list(collections.deque(console_lines(j, buildurl, stop), maxlen=args.tail))
+
+
+def scan_consoles(j, name, joburl, numbers, args, maxhits=None):
+    '''
+    Scan the consoles of builds numbers of job name, up to args.jobs at
+    a time, printing results newest to oldest (and, on stderr, any
+    console that couldn't be read).  Once maxhits matches
+    have been printed, in-flight scans are stopped and the rest never
+    start.  Returns the number of matching lines printed.
+    '''
+    stop = threading.Event()
+    printed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as ex:
+        futures = [ex.submit(scan_console, j, f'{joburl}{n}/', args, stop) for n in numbers]
+        for n, f in zip(numbers, futures):
+            try:
+                lines = f.result()
+            except (jenkins.JenkinsException, requests.exceptions.RequestException) as e:
+                # e.g. the log was rotated away since the build list was read
+                print(f'{name} #{n}: could not read console: {e}', file=sys.stderr)
+                continue
+            for line in lines:
+                if maxhits is not None and printed >= maxhits:
+                    break
+                print(f'{name} #{n}: {line}')
+                printed += 1
+            if maxhits is not None and printed >= maxhits:
+                stop.set()
+                for f in futures:
+                    f.cancel()
+                break
+    return printed
+
+
+def get_jobindex(j, refresh=False, usecache=True):
+    '''
+    Return the server's jobs (name, url, color), from a local copy if
+    one's been saved in the last JOBINDEX_TTL seconds, else with one
+    tree-filtered request (saving the result).
+    '''
+    path = os.path.join(CACHE_DIR, 'jobindex.json')
+    if usecache and not refresh:
+        try:
+            with open(path) as f:
+                index = json.load(f)
+            if index['server'] == JENKINS_URL and time.time() - index['time'] < JOBINDEX_TTL:
+                return index['jobs']
+        except (OSError, ValueError, KeyError):
+            pass
+    jobs = jenkins_get(j, f'{JENKINS_URL}/api/json?tree=jobs[name,url,color]')['jobs']
+    if usecache:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}'
+        with open(tmp, 'w') as f:
+            json.dump(dict(server=JENKINS_URL, time=time.time(), jobs=jobs), f)
+        os.replace(tmp, path)
+    return jobs
+
+
 def main():
     jenkins_user=os.environ.get('JENKINS_USER')
     jenkins_token=os.environ.get('JENKINS_TOKEN')
-    j=jenkins.Jenkins('https://jenkins.ceph.com', jenkins_user, jenkins_token)
+    j=jenkins.Jenkins(JENKINS_URL, jenkins_user, jenkins_token)
 
     args = parse_args()
+    if args.stats:
+        # find out now, not after fetching every build
+        if importlib.util.find_spec('numpy') is None:
+            print('--stats needs numpy', file=sys.stderr)
+            return 1
+    if args.jobs > 1:
+        share_connections(j, args.jobs)
 
+    joblist = get_jobindex(j, args.refresh, not args.nocache)
     if args.list:
-        ji = j.get_info()
-        jobs = ji['jobs']
-        for job in jobs:
+        for job in joblist:
             print(f'{job["name"]}')
         return 0
 
     # jobinfo = j.get_job_info_regex(args.jobre)
     # get_job_info_regex doesn't allow passing "fetch_all_builds", so
-    # recreate it here
-    joblist = j.get_all_jobs()
-    jobinfo = list()
-    for job in joblist:
-        if re.search(args.jobre, job['name']):
-            jobinfo.append(j.get_job_info(job['name'], fetch_all_builds=True))
-
+    # recreate it here, matching against the (cached) job list
+    matching = [job for job in joblist if re.search(args.jobre, job['name'])]
+    if not matching and not (args.refresh or args.nocache):
+        # the job may be newer than the saved list
+        joblist = get_jobindex(j, refresh=True)
+        matching = [job for job in joblist if re.search(args.jobre, job['name'])]
+    if not matching:
+        print(f'no jobs match {args.jobre}', file=sys.stderr)
+        return 1
+    joblist = matching
+    cache = None if args.nocache else BuildCache(JENKINS_URL)
+    hits = 0
+    if args.stats:
+        groupby = args.groupby.split(',')
+        keys, waits, durations, failed, aborted = list(), list(), list(), list(), list()
 
-    for ji in jobinfo:
-        name=ji['name']
-        if args.json:
-            outdict = dict(name=name, builds=list())
-        buildcount = 0
-        for build in ji['builds']:
-            if args.count and buildcount >= args.count:
-                break
-            buildcount += 1
-            buildnum = build['number']
-            bi = j.get_build_info(name, buildnum)
-            '''
-            {'_class': 'hudson.model.CauseAction',
-             'causes': [{'_class': 'org.jenkinsci.plugins.ghprb.GhprbCause',
-                 'shortDescription': 'GitHub pull request #56203 of commit '
-                                     'ab4c5daead7f26d41028625453d50bb58d3b02be,'
-                                     ' no merge conflicts.'}]}
-
-             {'_class': 'jenkins.metrics.impl.TimeInQueueAction',
-              'blockedDurationMillis': 0,
-              'blockedTimeMillis': 0,
-              'buildableDurationMillis': 4,
-              'buildableTimeMillis': 4,
-              'buildingDurationMillis': 985724,
-              'executingTimeMillis': 985724,
-              'executorUtilization': 1.0,
-              'subTaskCount': 0,
-              'waitingDurationMillis': 6797,
-              'waitingTimeMillis': 6797},
-
-            '''
-            reason = "??"
-            paramnames = list()
-            paramdict=dict()
-            for act in bi['actions']:
-                cls = act.get('_class', None)
-                if cls is None:
+    try:
+        for job in joblist:
+            name=job['name']
+            cached = cache.load(name) if cache else dict()
+            count, first = args.count, 0
+            if args.since or args.until or args.range:
+                first, end = build_window(j, job['url'], args)
+                if end is not None:
+                    count = min(count, end - first) if count else end - first
+                if count is not None and count <= 0:
                     continue
-
-                if cls.endswith('hudson.model.CauseAction'):
-                    if len(act['causes']) > 1:
-                        print(f'{name} #{buildnum} has more than one cause?', file=sys.stderr)
-                    reason = act['causes'][0]['shortDescription']
-
-                if cls.endswith('ParametersAction'):
-                    params = act['parameters']
-                    pois = ['BRANCH', 'ARCHS', 'DISTROS', 'FLAVOR']
-                    for param in params:
-                        paramnames.append(param['name'])
-                        if args.allparams or param['name'] in pois:
-                            paramdict[param['name']] = param['value']
-                
-                if cls.endswith('TimeInQueueAction'):
-                    waittime = None
-                    if bi['building'] == False:
-                        waittime = to_minsec(act['waitingTimeMillis'])
-
-            reason = decruft(reason)
-            start = ts_to_str(bi['timestamp'] / 1000)
-            age = int(int(time.time()) - (bi['timestamp'] / 1000))
-            if args.json:
-                outdict['builds'].append(output(name, buildnum, reason, paramdict, start, age, bi, waittime, returndict=True))
+            if args.grep or args.tail:
+                rng = f'{{{first},{first + count}}}' if count else f'{{{first},}}'
+                numbers = [b['number'] for b in
+                           jenkins_get(j, f'{job["url"]}api/json?tree=allBuilds[number]{rng}')['allBuilds']]
+                maxhits = None
+                if args.grep and args.maxhits:
+                    maxhits = args.maxhits - hits
+                hits += scan_consoles(j, name, job['url'], numbers, args, maxhits)
+                if maxhits is not None and hits >= args.maxhits:
+                    break
+                continue
+            if args.nobulk:
+                ji = j.get_job_info(name, fetch_all_builds=True)
+                builds = [cached.get(b['number'], b) for b in ji['builds'][first:]]
+            elif cached:
+                builds = get_builds_cached(j, job['url'], cached, count, first)
             else:
-                output(name, buildnum, reason, paramdict, start, age, bi, waittime, returndict=False)
-    if args.json:
-        print(json.dumps(outdict))
+                builds = get_builds_bulk(j, job['url'], count, first)
+            if count:
+                # trim before fetching so -c never asks for builds it won't show
+                builds = builds[:count]
+            if args.json:
+                outdict = dict(name=name, builds=list())
+            for bi in fill_builds(j, name, builds, args.jobs):
+                if 'reason' not in bi:
+                    bi = summarize(name, bi)
+                    if cache:
+                        cache.store(name, bi)
+                if args.stats:
+                    params = bi['params']
+                    keys.append(' '.join(name if k == 'job' else str(params.get(k, '')) for k in groupby))
+                    done = not bi['building']
+                    waits.append(bi.get('waitms') if done and bi.get('waitms') is not None else float('nan'))
+                    durations.append(bi['duration'] if done else float('nan'))
+                    # not aborts: superseded PR builds get aborted all the time
+                    failed.append(done and bi['result'] == 'FAILURE')
+                    aborted.append(done and bi['result'] == 'ABORTED')
+                    continue
+                buildnum = bi['number']
+                reason, waittime = bi['reason'], bi['waittime']
+                paramdict = bi['params']
+                if not args.allparams:
+                    paramdict = {k: v for k, v in paramdict.items() if k in POIS}
+                start = ts_to_str(bi['timestamp'] / 1000)
+                age = int(int(time.time()) - (bi['timestamp'] / 1000))
+                if args.ndjson:
+                    line = dict(name=name)
+                    line.update(output(name, buildnum, reason, paramdict, start, age, bi, waittime, returndict=True))
+                    print(json.dumps(line), flush=True)
+                elif args.json:
+                    outdict['builds'].append(output(name, buildnum, reason, paramdict, start, age, bi, waittime, returndict=True))
+                else:
+                    output(name, buildnum, reason, paramdict, start, age, bi, waittime, returndict=False)
+            if args.json and not (args.ndjson or args.stats):
+                # one document per job, so a regex matching several jobs shows all of them
+                print(json.dumps(outdict))
+    finally:
+        # keep what was fetched even if we're interrupted
+        if cache:
+            cache.close()
+    if args.stats:
+        stats = build_stats(keys, waits, durations, failed, aborted)
+        if args.json:
+            print(json.dumps(stats))
+        else:
+            print_stats(stats)
 
 if __name__ == "__main__":
     sys.exit(main())
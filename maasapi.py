@@ -1,12 +1,16 @@
 #!/usr/bin/python3
 
 import argparse
+import functools
+import hashlib
+import json
 import os
+import random
+import re
 import requests
 import secrets
 import sys
-from datetime import datetime
-import pprint
+import time
 from urllib.parse import urlsplit, urlunsplit
 
 '''
@@ -16,80 +20,593 @@ maasapi machines
 
 (will add a trailing '/' to the path if none exists)
 
+or a whole file of them, run concurrently, with --batch:
+
+echo 'GET machines
+POST tags name=foo;comment=bar' | maasapi --batch -
+
+GET responses are cached under ~/.cache/ci-tools/maasapi: reused for
+--ttl seconds, then revalidated with ETag/Last-Modified.  Any other
+method invalidates the cached entries for that collection.
+
 Put your api key in ~/maas-api-key, or someplace more secure
 (inside a password manager, perhaps)
+
+Other tools can import this (it doesn't read the key until it's
+first needed) and use MaasClient, or AsyncMaasClient from asyncio code:
+
+client = MaasClient()
+ok, resp = client.get('machines')
+for m in client.records('machines', fields=['hostname', 'status_name']):
+    ...
 '''
 
-APIKEY=open(os.path.expanduser('~/maas-api-key')).read().strip()
+DEFAULT_SERVER = 'soko02.front.sepia.ceph.com'
+KEYFILE = '~/maas-api-key'
 
-CONSUMER, TOKEN, SECRET = APIKEY.split(':')
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'ci-tools', 'maasapi')
+
+@functools.lru_cache(maxsize=None)
+def load_credentials(keyfile=KEYFILE):
+    '''
+    (consumer, token, secret) from the API key in keyfile
+    '''
+    with open(os.path.expanduser(keyfile)) as f:
+        consumer, token, secret = f.read().strip().split(':')
+    return consumer, token, secret
 
 def oauth_header(consumer, token, secret):
     nonce = secrets.token_urlsafe(16)
-    timestamp = int(datetime.now().timestamp())
+    timestamp = int(time.time())
     return f'OAuth oauth_version="1.0", oauth_signature_method="PLAINTEXT", oauth_consumer_key="{consumer}", oauth_token="{token}", oauth_signature="&{secret}", oauth_nonce="{nonce}", oauth_timestamp="{timestamp}"'
 
+def key_value(s):
+    if '=' not in s:
+        raise argparse.ArgumentTypeError(f'{s!r} is not key=value')
+    return s
+
 def parse_args():
     ap = argparse.ArgumentParser()
     ap.add_argument('-X', help='http method', default='GET')
     ap.add_argument('-d', '--data', help='form data (if any), k1=v1;k2=v2')
-    ap.add_argument('-s', '--server', help='MAAS server', default='soko02.front.sepia.ceph.com')
+    ap.add_argument('-s', '--server', help='MAAS server', default=DEFAULT_SERVER)
     ap.add_argument('-v', '--verbose', help='show request', action='store_true')
     ap.add_argument('-V', '--version', help='api version', default='2.0')
-    ap.add_argument('endpoint', help='API endpoint')
+    ap.add_argument('-f', '--fields', help='only output these (comma-separated) fields of each record, one json record per line')
+    ap.add_argument('-F', '--filter', action='append', type=key_value, help='only output records with key=value, value as JSON unless a string, e.g. locked=false (may be repeated)')
+    ap.add_argument('-t', '--ttl', type=float, default=10, help='seconds to use a cached GET response without asking MAAS (default 10)')
+    ap.add_argument('-n', '--nocache', action='store_true', help="don't use or update the response cache")
+    ap.add_argument('-r', '--retries', type=int, default=3, help='times to retry when MAAS says 503 (busy), with backoff (default 3)')
+    ap.add_argument('-b', '--batch', help="file ('-' for stdin) of 'METHOD endpoint [k1=v1;k2=v2]' lines to run; prints ndjson")
+    ap.add_argument('-j', '--jobs', type=int, default=8, help='requests in flight at once with --batch (default 8)')
+    ap.add_argument('endpoint', nargs='?', help='API endpoint')
     return ap.parse_args()
 
-def do_request(method, url, headers=None, data=None, verbose=False):
-    if headers is None:
-        headers={
-            'Authorization' : oauth_header(CONSUMER, TOKEN, SECRET),
-            'Accept' : 'application/json',
-        }
-    req = requests.Request(
-        method=method,
-        url=url,
-        headers=headers,
-        data=data,
-    )
-    if verbose:
-        pprint.pprint(req.__dict__, stream=sys.stderr)
+class CachedResponse:
+    '''
+    Enough of a requests.Response to stand in for a cached GET
+    '''
+    status_code = 200
+    reason = 'OK (cached)'
+    encoding = 'utf-8'
+
+    def __init__(self, bodypath):
+        self.bodypath = bodypath
+
+    @property
+    def text(self):
+        with open(self.bodypath, encoding='utf-8') as f:
+            return f.read()
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=65536, decode_unicode=True):
+        with open(self.bodypath, encoding='utf-8') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+class CachingResponse:
+    '''
+    Wrap a (streamed) 200 response to a GET, saving the body to the
+    cache as it's read, however it's read
+    '''
+    def __init__(self, cache, url, resp):
+        self.cache = cache
+        self.url = url
+        self.resp = resp
+        self.status_code = resp.status_code
+        self.reason = resp.reason
+
+    @property
+    def encoding(self):
+        return self.resp.encoding
+
+    @encoding.setter
+    def encoding(self, value):
+        self.resp.encoding = value
+
+    @property
+    def text(self):
+        text = self.resp.text
+        for _ in self.cache.store(self.url, self.resp, [text]):
+            pass
+        return text
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=65536, decode_unicode=True):
+        if self.resp.encoding is None:
+            self.resp.encoding = 'utf-8'
+        chunks = self.resp.iter_content(chunk_size=chunk_size, decode_unicode=True)
+        yield from self.cache.store(self.url, self.resp, chunks)
+
+class ResponseCache:
+    '''
+    GET responses on disk, one meta (.json) and one body file per URL
+    (which has the server and API version in it).  Entries younger than
+    ttl are used as-is; older ones are revalidated with ETag or
+    Last-Modified if MAAS sent them.  With invalidate_only, nothing is
+    cached or read from the cache, but changes still forget what other
+    runs cached.  Bodies can hold secrets (power_parameters has BMC
+    passwords), so the directory and files are private to the user.
+    '''
+    def __init__(self, ttl, cachedir=CACHE_DIR, invalidate_only=False):
+        self.ttl = ttl
+        self.cachedir = cachedir
+        self.invalidate_only = invalidate_only
+        os.makedirs(cachedir, mode=0o700, exist_ok=True)
+        os.chmod(cachedir, 0o700)
+
+    def _create(self, path):
+        return os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8')
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode()).hexdigest()
+        base = os.path.join(self.cachedir, key)
+        return base + '.json', base + '.body'
+
+    def lookup(self, url):
+        metapath, bodypath = self._paths(url)
+        try:
+            with open(metapath, encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None, bodypath
+        if meta.get('url') != url or not os.path.exists(bodypath):
+            return None, bodypath
+        return meta, bodypath
+
+    def fresh(self, meta):
+        return time.time() - meta['time'] < self.ttl
+
+    def _write_meta(self, url, meta):
+        metapath, _ = self._paths(url)
+        tmp = f'{metapath}.{os.getpid()}.{id(meta)}'
+        with self._create(tmp) as f:
+            json.dump(meta, f)
+        os.replace(tmp, metapath)
+
+    def touch(self, url, meta):
+        meta['time'] = time.time()
+        self._write_meta(url, meta)
+
+    def store(self, url, resp, chunks):
+        '''
+        Yield chunks (text) while writing them to url's body file; once
+        they're all through, save the metadata that makes it an entry
+        '''
+        _, bodypath = self._paths(url)
+        tmp = f'{bodypath}.{os.getpid()}.{id(chunks)}'
+        try:
+            with self._create(tmp) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp, bodypath)
+        finally:
+            # if the reader stopped early (or the read failed), don't
+            # leave the partial body behind
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+        self._write_meta(url, dict(
+            url=url,
+            path=urlsplit(url).path,
+            server=urlsplit(url).netloc,
+            time=time.time(),
+            etag=resp.headers.get('ETag'),
+            last_modified=resp.headers.get('Last-Modified'),
+        ))
+
+    def invalidate(self, url):
+        '''
+        Forget cached entries for url's collection (e.g. everything
+        under machines/ for a POST to machines/abc123/)
+        '''
+        parts = urlsplit(url)
+        m = re.match(r'(/MAAS/(?:api/[^/]+|a/[^/]+)/[^/]+/)', parts.path)
+        prefix = m.group(1) if m else parts.path
+        for name in os.listdir(self.cachedir):
+            if not name.endswith('.json'):
+                continue
+            metapath = os.path.join(self.cachedir, name)
+            try:
+                with open(metapath, encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if meta.get('server') == parts.netloc and meta.get('path', '').startswith(prefix):
+                for path in (metapath, metapath[:-len('.json')] + '.body'):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+
+def retry_delay(resp, attempt, backoff):
+    '''
+    How long to wait before retrying a 503: Retry-After if MAAS sent
+    one, else exponential backoff with some jitter
+    '''
     try:
-        resp = requests.Session().send(req.prepare())
+        return float(resp.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return backoff * (2 ** attempt) * (0.5 + random.random())
+
+def do_request(method, url, headers=None, data=None, verbose=False, session=None, stream=False, cache=None,
+               retries=0, backoff=0.5, credentials=None):
+    caching = cache is not None and not cache.invalidate_only and method == 'GET'
+    meta = None
+    if caching:
+        meta, bodypath = cache.lookup(url)
+        if meta is not None and cache.fresh(meta):
+            if verbose:
+                print(f'{url}: from cache', file=sys.stderr)
+            return True, CachedResponse(bodypath)
+        # stream, so the body can be saved as it's read
+        stream = True
+    if session is None:
+        session = requests.Session()
+
+    for attempt in range(retries + 1):
+        if headers is None or attempt:
+            # every attempt needs a new nonce
+            if credentials is None:
+                credentials = load_credentials()
+            reqheaders = {
+                'Authorization' : oauth_header(*credentials),
+                'Accept' : 'application/json',
+            }
+            if headers:
+                reqheaders = dict(headers, Authorization=reqheaders['Authorization'])
+        else:
+            reqheaders = dict(headers)
+        if meta is not None:
+            if meta.get('etag'):
+                reqheaders['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                reqheaders['If-Modified-Since'] = meta['last_modified']
+        req = requests.Request(
+            method=method,
+            url=url,
+            headers=reqheaders,
+            data=data,
+        )
+        if verbose:
+            import pprint
+            pprint.pprint(req.__dict__, stream=sys.stderr)
+        resp = session.send(req.prepare(), stream=stream)
+        if resp.status_code != 503 or attempt == retries:
+            break
+        delay = retry_delay(resp, attempt, backoff)
+        resp.close()
+        if verbose:
+            print(f'{url}: 503, retrying in {delay:.1f}s', file=sys.stderr)
+        time.sleep(delay)
+
+    try:
+        if caching and resp.status_code == 304 and meta is not None:
+            resp.close()
+            cache.touch(url, meta)
+            return True, CachedResponse(bodypath)
         resp.raise_for_status()
     except requests.exceptions.HTTPError as e:
         resp = e.response
         if verbose:
-            print(f'{url}: {resp.status_code} {resp._content.decode()}', file=sys.stderr)
+            print(f'{url}: {resp.status_code} {resp.text}', file=sys.stderr)
         else:
             print(f'{url}: {resp.status_code} {resp.reason}', file=sys.stderr)
-        return False, ""
+        return False, resp
+    if caching and resp.status_code == 200:
+        return True, CachingResponse(cache, url, resp)
+    if cache is not None and method != 'GET':
+        cache.invalidate(url)
     return True, resp
 
-def main():
-    args = parse_args()
-    ep = urlsplit(args.endpoint)
+def make_url(server, version, endpoint):
+    ep = urlsplit(endpoint)
     # add a / if it needs it
     newpath = ep.path
     if newpath[-1] != '/':
         newpath += '/'
     ep = urlunsplit(('', '', newpath, ep.query, ep.fragment))
 
-    datadict = None
-    if args.data:
-        datadict = dict()
-        for datum in args.data.split(';'):
-            dk, dv = datum.split('=')
-            datadict[dk] = dv
-
     # I think authentication changes in api v3 as well, but
     # this at least let me grab an openapi.json to play with
 
-    if args.version == '3':
-        api_url=f'http://{args.server}:5240/MAAS/a/3/{ep}'
-    else:
-        api_url=f'http://{args.server}:5240/MAAS/api/2.0/{ep}'
+    if version == '3':
+        return f'http://{server}:5240/MAAS/a/3/{ep}'
+    return f'http://{server}:5240/MAAS/api/2.0/{ep}'
+
+def parse_data(data):
+    '''
+    'k1=v1;k2=v2' to a dict (or None if no data)
+    '''
+    if not data:
+        return None
+    datadict = dict()
+    for datum in data.split(';'):
+        dk, dv = datum.split('=')
+        datadict[dk] = dv
+    return datadict
+
+def iter_json_records(chunks):
+    '''
+    Yield the elements of a JSON array (or the one value, if it's not an
+    array) as they arrive in chunks of text, holding only the current
+    element in memory rather than the whole document.  Raises
+    JSONDecodeError if the text ends before the array does.
+    '''
+    chunks = iter(chunks)
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+    for chunk in chunks:
+        buf = buf[pos:] + chunk
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buf):
+                break
+            if not started:
+                started = True
+                if buf[pos] == '[':
+                    pos += 1
+                    continue
+                # not an array; wait for all of it
+                buf = ''.join([buf[pos:]] + list(chunks))
+                yield json.loads(buf)
+                return
+            if buf[pos] == ']':
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # incomplete; get more
+                break
+            if end == len(buf) and not isinstance(obj, (dict, list)):
+                # a number might go on in the next chunk
+                break
+            pos = end
+            yield obj
+    if started and buf[pos:].strip():
+        raise json.JSONDecodeError('incomplete array element', buf, pos)
+    if started:
+        raise json.JSONDecodeError('array not closed', buf, len(buf))
+
+def get_field(record, field):
+    '''
+    record[field], where field may be dotted to reach into sub-objects
+    '''
+    for key in field.split('.'):
+        if not isinstance(record, dict):
+            return None
+        record = record.get(key)
+    return record
+
+def project(records, fields=None, filters=None):
+    '''
+    Yield records matching all of filters (key=value strings; value
+    is compared to the field as JSON, e.g. locked=false, owner=null,
+    unless the field is a string), cut down to fields if given
+    '''
+    def as_text(value):
+        return value if isinstance(value, str) else json.dumps(value)
+
+    wanted = [f.split('=', 1) for f in filters or []]
+    for record in records:
+        if any(as_text(get_field(record, k)) != v for k, v in wanted):
+            continue
+        if fields:
+            record = {f: get_field(record, f) for f in fields}
+        yield record
+
+class MaasClient:
+    '''
+    Talk to one MAAS region over one pooled keep-alive session.  The
+    API key is read from keyfile (unless given as apikey) on the first
+    request, not before.  503s from a busy region controller are
+    retried up to retries times with exponential backoff; with ttl,
+    GETs go through a ResponseCache.  Safe to share between threads.
+    '''
+    def __init__(self, server=DEFAULT_SERVER, version='2.0', keyfile=KEYFILE, apikey=None,
+                 ttl=None, retries=3, backoff=0.5, poolsize=8, verbose=False):
+        self.server = server
+        self.version = version
+        self.keyfile = keyfile
+        self.apikey = apikey
+        self.retries = retries
+        self.backoff = backoff
+        self.verbose = verbose
+        # even uncached, a change has to drop what other runs cached
+        self.cache = ResponseCache(0, invalidate_only=True) if ttl is None else ResponseCache(ttl)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=poolsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @property
+    def credentials(self):
+        if self.apikey is not None:
+            return tuple(self.apikey.split(':'))
+        return load_credentials(self.keyfile)
+
+    def request(self, method, endpoint, data=None, stream=False):
+        '''
+        Returns (success, response), like do_request().  data is a dict,
+        or a 'k1=v1;k2=v2' string.
+        '''
+        if isinstance(data, str):
+            data = parse_data(data)
+        url = make_url(self.server, self.version, endpoint)
+        return do_request(method.upper(), url, None, data, self.verbose, self.session, stream, self.cache,
+                          self.retries, self.backoff, self.credentials)
+
+    def get(self, endpoint, **kwargs):
+        return self.request('GET', endpoint, **kwargs)
+
+    def post(self, endpoint, data=None, **kwargs):
+        return self.request('POST', endpoint, data, **kwargs)
+
+    def put(self, endpoint, data=None, **kwargs):
+        return self.request('PUT', endpoint, data, **kwargs)
+
+    def delete(self, endpoint, **kwargs):
+        return self.request('DELETE', endpoint, **kwargs)
+
+    def records(self, endpoint, fields=None, filters=None):
+        '''
+        Yield the (projected, filtered; see project()) records of a GET
+        of endpoint as they stream in.  Raises HTTPError on failure.
+        '''
+        success, resp = self.get(endpoint, stream=True)
+        if not success:
+            resp.raise_for_status()
+        if resp.encoding is None:
+            resp.encoding = 'utf-8'
+        yield from project(iter_json_records(resp.iter_content(chunk_size=65536, decode_unicode=True)),
+                           fields, filters)
+
+class AsyncMaasClient:
+    '''
+    MaasClient for asyncio code: the same request/get/post/put/delete,
+    as coroutines.  Requests run on worker threads sharing one
+    MaasClient (and so one session), at most concurrency at once.
+    '''
+    def __init__(self, *args, concurrency=8, **kwargs):
+        self.client = MaasClient(*args, poolsize=concurrency, **kwargs)
+        self.concurrency = concurrency
+        self._sem = None
+
+    async def request(self, method, endpoint, data=None):
+        import asyncio
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.concurrency)
+        async with self._sem:
+            return await asyncio.to_thread(self._request, method, endpoint, data)
 
-    success, resp = do_request(args.X, api_url, None, datadict, args.verbose)
+    def _request(self, method, endpoint, data):
+        success, resp = self.client.request(method, endpoint, data)
+        # read the body here, not on the event loop
+        resp.text
+        return success, resp
+
+    async def get(self, endpoint):
+        return await self.request('GET', endpoint)
+
+    async def post(self, endpoint, data=None):
+        return await self.request('POST', endpoint, data)
+
+    async def put(self, endpoint, data=None):
+        return await self.request('PUT', endpoint, data)
+
+    async def delete(self, endpoint):
+        return await self.request('DELETE', endpoint)
+
+def client_from_args(args, poolsize=8):
+    return MaasClient(args.server, args.version, ttl=None if args.nocache else args.ttl,
+                      retries=args.retries, poolsize=poolsize, verbose=args.verbose)
+
+def run_batch(args):
+    '''
+    Run each 'METHOD endpoint [data]' line of args.batch, args.jobs at
+    a time over one keep-alive session, printing each result as a json
+    line tagged with its input line number as it finishes.  Every
+    request gets its own OAuth header (and so its own nonce).
+    '''
+    import concurrent.futures
+
+    f = sys.stdin if args.batch == '-' else open(args.batch)
+    requests_todo = list()
+    for lineno, line in enumerate(f, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        method, endpoint, *data = line.split(maxsplit=2)
+        requests_todo.append((lineno, method.upper(), endpoint, data[0] if data else None))
+    if f is not sys.stdin:
+        f.close()
+
+    client = client_from_args(args, poolsize=args.jobs)
+
+    def run(todo):
+        lineno, method, endpoint, data = todo
+        result = dict(line=lineno, method=method, endpoint=endpoint)
+        try:
+            success, resp = client.request(method, endpoint, data)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            result.update(ok=False, error=str(e))
+            return result
+        result.update(ok=success, status=resp.status_code)
+        try:
+            result['body'] = resp.json()
+        except ValueError:
+            result['body'] = resp.text
+        return result
+
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as ex:
+        futures = [ex.submit(run, todo) for todo in requests_todo]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            if not result['ok']:
+                failed += 1
+            print(json.dumps(result), flush=True)
+    return 1 if failed else 0
+
+def main():
+    args = parse_args()
+    if args.batch:
+        return run_batch(args)
+    if not args.endpoint:
+        print('need an endpoint (or --batch)', file=sys.stderr)
+        return 1
+
+    datadict = parse_data(args.data)
+
+    projecting = bool(args.fields or args.filter)
+    client = client_from_args(args, poolsize=1)
+    success, resp = client.request(args.X, args.endpoint, datadict, stream=projecting)
+    if success and projecting:
+        fields = args.fields.split(',') if args.fields else None
+        if resp.encoding is None:
+            resp.encoding = 'utf-8'
+        records = iter_json_records(resp.iter_content(chunk_size=65536, decode_unicode=True))
+        try:
+            for record in project(records, fields, args.filter):
+                print(json.dumps(record), flush=True)
+        except (ValueError, requests.exceptions.RequestException) as e:
+            # don't let a cut-off listing pass for a short one
+            print(f'{args.endpoint}: bad or incomplete response: {e}', file=sys.stderr)
+            return 1
+        return 0
     if success:
         print(resp.text)
         return 0
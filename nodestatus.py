@@ -1,19 +1,42 @@
 #!/home/dmick/v/bin/python3
 import argparse
 import datetime
+import http.server
+import json
+import mmap
+import operator
 import os
-import jenkins
+import re
 import requests
+import struct
 import sys
+import threading
 import time
 
+JENKINS_URL = 'https://jenkins.ceph.com'
 jenkins_user=os.environ.get('JENKINS_USER')
 jenkins_token=os.environ.get('JENKINS_TOKEN')
-j=jenkins.Jenkins('https://jenkins.ceph.com', jenkins_user, jenkins_token)
+auth = (jenkins_user, jenkins_token) if jenkins_user and jenkins_token else None
+
+# everything main() needs about every node, in one request
+NODE_TREE = (
+    'computer[displayName,offline,temporarilyOffline,'
+    'offlineCause[description,timestamp],assignedLabels[name],'
+    'executors[currentExecutable[url]]]'
+)
 
 def parse_args():
     ap = argparse.ArgumentParser()
     ap.add_argument('-o', '--offline', action='store_true', help='Show only offline nodes')
+    ap.add_argument('-w', '--watch', type=float, metavar='SECONDS', help='Poll every SECONDS and show only what changed')
+    ap.add_argument('-s', '--serve', type=int, metavar='PORT', help='Serve Prometheus metrics on PORT')
+    ap.add_argument('-i', '--interval', type=float, default=30, help='Seconds between refreshes with --serve/--record (default 30)')
+    ap.add_argument('--record', metavar='FILE', help='Sample executor use every --interval seconds into history FILE')
+    ap.add_argument('--report', metavar='FILE', help='Report executor utilization per label from history FILE')
+    ap.add_argument('--slots', type=int, default=20160, help='Samples a new --record FILE holds (default 20160, a week at the default --interval)')
+    ap.add_argument('--maxnodes', type=int, default=512, help='Nodes a new --record FILE has room for (default 512)')
+    ap.add_argument('--window', default='1d', help='How far back --report looks (e.g. 6h, 7d; default 1d)')
+    ap.add_argument('--sets', nargs='*', help="Label sets to --report on, e.g. 'arm64 jammy' 'amd64 centos9' (default: each label)")
     ap.add_argument('nodes', nargs='*')
     return ap.parse_args()
 
@@ -22,62 +45,419 @@ def shortname(s):
         return s
     return s[s.index('+')+1:]
 
-def main():
-    args=parse_args()
-    print("getting nodelist...", end='', file=sys.stderr)
-    nodes = j.get_nodes()
-    newnodes = list()
-    nodes = [n for n in nodes if shortname(n['name']) in args.nodes]
-    print(f'{len(nodes)} nodes found', file=sys.stderr)
+def get_nodetojob(session=requests, nodes=None):
+    '''
+    Fetch the state of every node with one request, and return a dict
+    of node name to {'tags': [...]}, plus 'offline': reason for offline
+    nodes, or 'builds': [url, ...] for busy ones.  If nodes is given,
+    only return nodes whose short names are in it.
+    '''
+    resp = session.get(f'{JENKINS_URL}/computer/api/json', params=dict(tree=NODE_TREE), auth=auth)
+    resp.raise_for_status()
 
     nodetojob = dict()
-    if not args.offline:
-        print("getting active builds...", end='', file=sys.stderr, flush=True)
-    for node in nodes:
-        name=node['name']
+    for nodeinfo in resp.json()['computer']:
+        name = nodeinfo['displayName']
+        if nodes and shortname(name) not in nodes:
+            continue
         if 'Built' in name:
             name='(master)'
-        nodeinfo = j.get_node_info(name)
         nodetojob[name] = dict()
         nodetojob[name]['tags'] = \
             [t['name'] for t in nodeinfo['assignedLabels'] if '+' not in t['name']]
-        # node_info(depth=2) is too expensive.  Get just the running jobs.
+        nodetojob[name]['executors'] = len(nodeinfo['executors'])
 
         if nodeinfo['offline']:
-            temp = "temporarily " if nodeinfo['temporarilyOffline'] else ""
-            cause = ""
-            if temp:
-                r = requests.get(f'https://jenkins.ceph.com/computer/{name}/api/json?tree=offlineCause[description,timestamp]')
-                cause = r.json()['offlineCause']
+            if nodeinfo['temporarilyOffline']:
+                cause = nodeinfo.get('offlineCause') or dict()
                 desc = cause.get('description', '??')
                 ts = cause.get('timestamp', None)
                 if ts:
                     ts = datetime.datetime.fromtimestamp(ts/1000).strftime('%b %d')
-            hostname = name[name.find('+')+1:]
-            if temp:
-                nodetojob[name]['offline'] = f'{temp}offline: {ts} {desc}'
+                nodetojob[name]['offline'] = f'temporarily offline: {ts} {desc}'
             else:
                 nodetojob[name]['offline'] = 'offline'
             continue
-        print(".", end='', file=sys.stderr, flush=True)
-
-        req = f'https://jenkins.ceph.com/computer/{name}/api/json?tree=executors[currentExecutable[url],busyExecutors,idleExecutors]'
-        start = time.time()
-        resp = requests.get(req)
-        end = time.time()
 
-        resp.raise_for_status()
-        builds=resp.json()
-        for b in builds['executors']:
+        for b in nodeinfo['executors']:
             ce = b['currentExecutable']
             if not ce:
                 continue
             if not 'builds' in nodetojob[name]:
                 nodetojob[name]['builds'] = list()
             nodetojob[name]['builds'].append(ce['url'])
-    if args.offline:
+    return nodetojob
+
+def node_changes(old, new):
+    '''
+    Compare two get_nodetojob() snapshots and return a list of
+    (name, what changed) for nodes that went offline or came back,
+    went idle or busy, or started new builds
+    '''
+    changes = list()
+    for name, v in new.items():
+        o = old.get(name)
+        if o is None:
+            changes.append((name, 'appeared'))
+            continue
+        if 'offline' in v:
+            if o.get('offline') != v['offline']:
+                changes.append((name, v['offline']))
+            continue
+        if 'offline' in o:
+            changes.append((name, 'back online'))
+        oldbuilds = o.get('builds', list())
+        newbuilds = v.get('builds', list())
+        if oldbuilds and not newbuilds:
+            changes.append((name, 'idle'))
+        elif newbuilds and not oldbuilds and 'offline' not in o:
+            changes.append((name, 'busy'))
+        for b in newbuilds:
+            if b not in oldbuilds:
+                changes.append((name, f'started {b}'))
+    for name in old:
+        if name not in new:
+            changes.append((name, 'disappeared'))
+    return changes
+
+def watch(args):
+    '''
+    Poll every args.watch seconds over one keep-alive session, printing
+    only the transitions since the last poll
+    '''
+    session = requests.Session()
+    nodetojob = get_nodetojob(session, args.nodes)
+    print(f'watching {len(nodetojob)} nodes', file=sys.stderr)
+    next_poll = time.monotonic()
+    while True:
+        # after a slow poll, start over from now rather than polling
+        # back to back to catch up
+        next_poll = max(next_poll + args.watch, time.monotonic())
+        time.sleep(max(0, next_poll - time.monotonic()))
+        try:
+            new = get_nodetojob(session, args.nodes)
+        except requests.exceptions.RequestException as e:
+            print(f'{time.strftime("%H:%M:%S")} poll failed: {e}', file=sys.stderr)
+            continue
+        now = time.strftime('%H:%M:%S')
+        for name, change in node_changes(nodetojob, new):
+            print(f'{now} {shortname(name)}: {change}', flush=True)
+        nodetojob = new
+
+def prom_escape(s):
+    return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def metrics_text(nodetojob, refreshed, errors):
+    '''
+    Format a get_nodetojob() snapshot as Prometheus text exposition
+    '''
+    labelcounts = dict()
+    offlinelines = list()
+    execlines = list()
+    for name, v in nodetojob.items():
+        node = prom_escape(shortname(name))
+        if 'offline' in v:
+            state = 'offline'
+        elif 'builds' in v:
+            state = 'busy'
+        else:
+            state = 'idle'
+        for tag in v['tags']:
+            counts = labelcounts.setdefault(tag, dict(idle=0, busy=0, offline=0))
+            counts[state] += 1
+        busy = len(v.get('builds', list()))
+        idle = 0 if state == 'offline' else v['executors'] - busy
+        offlinelines.append(f'jenkins_node_offline{{node="{node}"}} {int(state == "offline")}')
+        execlines.append(f'jenkins_node_executors{{node="{node}",state="busy"}} {busy}')
+        execlines.append(f'jenkins_node_executors{{node="{node}",state="idle"}} {idle}')
+
+    lines = [
+        '# HELP jenkins_label_nodes Nodes with each label, by state',
+        '# TYPE jenkins_label_nodes gauge',
+    ]
+    for tag, counts in sorted(labelcounts.items()):
+        for state, n in counts.items():
+            lines.append(f'jenkins_label_nodes{{label="{prom_escape(tag)}",state="{state}"}} {n}')
+    lines += [
+        '# HELP jenkins_node_offline Whether the node is offline',
+        '# TYPE jenkins_node_offline gauge',
+    ]
+    lines += offlinelines
+    lines += [
+        '# HELP jenkins_node_executors Executors on the node, by state',
+        '# TYPE jenkins_node_executors gauge',
+    ]
+    lines += execlines
+    lines += [
+        '# HELP nodestatus_last_refresh_timestamp_seconds When the snapshot was taken',
+        '# TYPE nodestatus_last_refresh_timestamp_seconds gauge',
+        f'nodestatus_last_refresh_timestamp_seconds {refreshed:.0f}',
+        '# HELP nodestatus_refresh_errors_total Failed snapshot refreshes',
+        '# TYPE nodestatus_refresh_errors_total counter',
+        f'nodestatus_refresh_errors_total {errors}',
+    ]
+    return ('\n'.join(lines) + '\n').encode()
+
+def serve(args):
+    '''
+    Refresh one snapshot every args.interval seconds in the background,
+    and serve it to any number of scrapers on args.serve, so Jenkins
+    sees one query per interval no matter how many readers there are
+    '''
+    session = requests.Session()
+    nodetojob = get_nodetojob(session, args.nodes)
+    refreshed = time.time()
+    snapshot = dict(body=metrics_text(nodetojob, refreshed, 0))
+
+    def refresh(nodetojob, refreshed):
+        errors = 0
+        next_poll = time.monotonic()
+        while True:
+            next_poll = max(next_poll + args.interval, time.monotonic())
+            time.sleep(max(0, next_poll - time.monotonic()))
+            try:
+                nodetojob = get_nodetojob(session, args.nodes)
+                refreshed = time.time()
+            except Exception as e:
+                # anything (an HTML error page, say) is a failed refresh;
+                # letting it end this thread would freeze the snapshot
+                errors += 1
+                print(f'{time.strftime("%H:%M:%S")} refresh failed: {e!r}', file=sys.stderr)
+            # swapping in a new body is atomic; readers never wait on Jenkins
+            snapshot['body'] = metrics_text(nodetojob, refreshed, errors)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = snapshot['body']
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *a):
+            pass
+
+    threading.Thread(target=refresh, args=(nodetojob, refreshed), daemon=True).start()
+    server = http.server.ThreadingHTTPServer(('', args.serve), Handler)
+    print(f'serving metrics on port {args.serve}', file=sys.stderr)
+    server.serve_forever()
+
+class UtilHistory:
+    '''
+    Busy and total executor counts per node per sample, in a fixed-size
+    ring in a memory-mapped file, so it can sample for days without
+    growing.  The file is a header, then a column of sample times,
+    then busy and total count matrices (slot x node index); the node
+    names and labels that go with the node indices are kept alongside
+    in FILE.nodes.  Once all maxnodes indices are used, those of nodes
+    that are gone and have aged out of the whole ring are reused.
+    '''
+    # magic, number of slots, max nodes, total samples ever written
+    HEADER = struct.Struct('<8sIIQ')
+    MAGIC = b'nodeutl1'
+
+    def __init__(self, path, slots=20160, maxnodes=512, create=True):
+        if not os.path.exists(path):
+            if not create:
+                raise FileNotFoundError(f'no history file {path}')
+            size = self.HEADER.size + slots * 8 + 2 * slots * maxnodes * 2
+            with open(path, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, slots, maxnodes, 0))
+                f.truncate(size)
+        self.f = open(path, 'r+b')
+        self.mm = mmap.mmap(self.f.fileno(), 0)
+        magic, self.slots, self.maxnodes, self.written = self.HEADER.unpack_from(self.mm)
+        if magic != self.MAGIC:
+            raise RuntimeError(f'{path} is not a utilization history file')
+        view = memoryview(self.mm)
+        off = self.HEADER.size
+        self.times = view[off:off + self.slots * 8].cast('d')
+        off += self.slots * 8
+        cells = self.slots * self.maxnodes
+        self.busy = view[off:off + cells * 2].cast('h')
+        self.total = view[off + cells * 2:off + cells * 4].cast('h')
+
+        self.nodespath = path + '.nodes'
+        self.nodes = list()
+        if os.path.exists(self.nodespath):
+            with open(self.nodespath) as f:
+                self.nodes = json.load(f)
+        self.nodeindex = {name: i for i, (name, tags) in enumerate(self.nodes)}
+
+    def _save_nodes(self):
+        tmp = f'{self.nodespath}.{os.getpid()}'
+        with open(tmp, 'w') as f:
+            json.dump(self.nodes, f)
+        os.replace(tmp, self.nodespath)
+
+    def _reclaim(self, nodetojob):
+        '''
+        Free and return the index of a node that's gone from Jenkins
+        and has no samples left anywhere in the ring, or None
+        '''
+        current = {shortname(name) for name in nodetojob}
+        end = min(self.written, self.slots) * self.maxnodes
+        for i, (name, tags) in enumerate(self.nodes):
+            if name in current or any(self.total[i:end:self.maxnodes]):
+                continue
+            del self.nodeindex[name]
+            return i
+        return None
+
+    def record(self, nodetojob, ts):
+        '''
+        Store one get_nodetojob() snapshot taken at ts, overwriting the
+        oldest sample once the ring is full
+        '''
+        changed = False
+        slot = self.written % self.slots
+        base = slot * self.maxnodes
+        for i in range(self.maxnodes):
+            self.busy[base + i] = 0
+            self.total[base + i] = 0
+        for name, v in nodetojob.items():
+            name = shortname(name)
+            i = self.nodeindex.get(name)
+            if i is None:
+                if len(self.nodes) < self.maxnodes:
+                    i = len(self.nodes)
+                    self.nodes.append([name, v['tags']])
+                else:
+                    i = self._reclaim(nodetojob)
+                    if i is None:
+                        print(f'no room for {name} in history', file=sys.stderr)
+                        continue
+                    self.nodes[i] = [name, v['tags']]
+                self.nodeindex[name] = i
+                changed = True
+            elif self.nodes[i][1] != v['tags']:
+                self.nodes[i][1] = v['tags']
+                changed = True
+            if 'offline' in v:
+                continue
+            self.busy[base + i] = len(v.get('builds', list()))
+            self.total[base + i] = v['executors']
+        if changed:
+            self._save_nodes()
+        self.times[slot] = ts
+        self.written += 1
+        self.HEADER.pack_into(self.mm, 0, self.MAGIC, self.slots, self.maxnodes, self.written)
+
+    def utilization(self, labelset, since):
+        '''
+        Fraction of executors busy, on online nodes with all of
+        labelset, for each sample taken at or after since
+        '''
+        n = min(self.written, self.slots)
+        idxs = [i for i, (name, tags) in enumerate(self.nodes) if labelset <= set(tags)]
+        if not idxs:
+            return list()
+        # pick the window's rows first, then sum just those nodes of
+        # each row at C speed, without copying anything else out
+        pick = operator.itemgetter(*idxs) if len(idxs) > 1 else lambda row: (row[idxs[0]],)
+        width = idxs[-1] + 1
+        fractions = list()
+        for slot, ts in enumerate(self.times[:n].tolist()):
+            if ts < since:
+                continue
+            base = slot * self.maxnodes
+            total = sum(pick(self.total[base:base + width]))
+            if total:
+                fractions.append(sum(pick(self.busy[base:base + width])) / total)
+        return fractions
+
+    def close(self):
+        self.times.release()
+        self.busy.release()
+        self.total.release()
+        self.mm.close()
+        self.f.close()
+
+def record(args):
+    '''
+    Sample executor use into args.record every args.interval seconds
+    '''
+    session = requests.Session()
+    history = UtilHistory(args.record, args.slots, args.maxnodes)
+    next_poll = time.monotonic()
+    try:
+        while True:
+            try:
+                history.record(get_nodetojob(session, args.nodes), time.time())
+            except requests.exceptions.RequestException as e:
+                print(f'{time.strftime("%H:%M:%S")} sample failed: {e}', file=sys.stderr)
+            next_poll = max(next_poll + args.interval, time.monotonic())
+            time.sleep(max(0, next_poll - time.monotonic()))
+    finally:
+        history.close()
+
+def percentile(values, q):
+    '''nearest-rank percentile of sorted values'''
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+def parse_window(s):
+    m = re.fullmatch(r'(\d+(?:\.\d+)?)([smhd])', s)
+    if not m:
+        raise ValueError(f'bad window {s}: use e.g. 90m, 6h, 7d')
+    return float(m.group(1)) * dict(s=1, m=60, h=3600, d=86400)[m.group(2)]
+
+def report(args):
+    '''
+    Print busy-executor percentages per label set over args.window
+    '''
+    try:
+        history = UtilHistory(args.report, create=False)
+    except (OSError, RuntimeError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    since = time.time() - parse_window(args.window)
+    if args.sets:
+        labelsets = [frozenset(s.split()) for s in args.sets]
+    else:
+        labelsets = sorted({frozenset([t]) for name, tags in history.nodes for t in tags},
+                           key=lambda s: sorted(s))
+    print(f'{"labels":30} {"samples":>7} {"mean%":>6} {"p50%":>6} {"p90%":>6} {"p99%":>6}')
+    for labelset in labelsets:
+        fractions = sorted(history.utilization(labelset, since))
+        name = ' '.join(sorted(labelset))
+        if not fractions:
+            print(f'{name:30} {0:>7}')
+            continue
+        mean = 100 * sum(fractions) / len(fractions)
+        p50, p90, p99 = (100 * percentile(fractions, q) for q in (50, 90, 99))
+        print(f'{name:30} {len(fractions):>7} {mean:>6.1f} {p50:>6.1f} {p90:>6.1f} {p99:>6.1f}')
+    history.close()
+    return 0
+
+def main():
+    args=parse_args()
+    if args.report:
+        return report(args)
+    if args.record:
+        try:
+            record(args)
+        except KeyboardInterrupt:
+            pass
         return 0
-    print(file=sys.stderr)
+    if args.serve:
+        try:
+            serve(args)
+        except KeyboardInterrupt:
+            pass
+        return 0
+    if args.watch:
+        try:
+            watch(args)
+        except KeyboardInterrupt:
+            pass
+        return 0
+    print("getting node status...", end='', file=sys.stderr, flush=True)
+    nodetojob = get_nodetojob(nodes=args.nodes)
+    print(f'{len(nodetojob)} nodes found', file=sys.stderr)
 
     idlecnt = busycnt = offlinecnt = 0
     for k,v in nodetojob.items():
@@ -88,6 +468,8 @@ def main():
             print(f'{name}: {v["offline"]} ({",".join(v["tags"])})')
             offlinecnt += 1
             continue
+        if args.offline:
+            continue
         if 'builds' in v:
             buildstr = f'{len(v["builds"])} active builds'
             busycnt += 1
@@ -99,6 +481,9 @@ def main():
             for b in v['builds']:
                 print(f'{b}')
         print()
+    if args.offline:
+        print(f'Offline: {offlinecnt}')
+        return 0
     print(f'Idle: {idlecnt}  Busy: {busycnt} Offline: {offlinecnt}')
 
 if __name__ == '__main__':